@@ -25,7 +25,7 @@ import tempfile
 from bottle import Bottle, request, response, template, static_file
 from subprocess import call
 
-from ybd import app, cache
+from ybd import app, cache, compression
 
 bottle = Bottle()
 
@@ -88,12 +88,33 @@ class KeyedBinaryArtifactServer(object):
         f = request.query.filename
         return static_file(f, root=app.config['artifact-dir'], download=True)
 
+    @bottle.post('/exists')
+    def exists():
+        '''Given a json list of cache-keys, return the ones we have.'''
+
+        found = []
+        for cache_id in request.json or []:
+            if re.match('^[a-zA-Z0-9\.\-\_\@]*$', cache_id) is None:
+                continue
+            if os.path.isfile(os.path.join(app.config['artifact-dir'],
+                                           cache_id, cache_id)):
+                found.append(cache_id)
+        return {'artifacts': found}
+
     @bottle.get('/get/<cache_id>')
     def get_artifact(cache_id):
         f = os.path.join(cache_id, cache_id)
         app.config['downloads'] += 1
-        return static_file(f, root=app.config['artifact-dir'], download=True,
-                           mimetype='application/x-tar')
+        artifact = static_file(f, root=app.config['artifact-dir'],
+                               download=True, mimetype='application/x-tar')
+        if artifact.status_code == 200:
+            # so the client can check and unpack the artifact as it downloads
+            path = os.path.join(app.config['artifact-dir'], f)
+            digests = compression.digests(path)
+            artifact.set_header('X-Checksum-MD5', digests['md5'])
+            artifact.set_header('X-Checksum-SHA256', digests['sha256'])
+            artifact.set_header('X-Codec', compression.detect(path))
+        return artifact
 
     @bottle.get('/')
     @bottle.get('/status')
@@ -144,20 +165,19 @@ class KeyedBinaryArtifactServer(object):
             upload = request.files.get('file')
             artifact = os.path.join(tmpdir, cache_id)
 
-            try:
-                upload.save(artifact)
-            except:
-                # upload.save is only available in recent versions of bottle
-                # troves (for example) have an older version... hence:
-                with open(artifact, "w") as f:
-                    f.write(upload.value)
-
-            if call(['tar', 'tf', artifact]):
-                app.log('UPLOAD', 'ERROR: not a valid tarfile:', artifact)
-                raise
-            checksum = cache.md5(artifact)
-            with open(artifact + '.md5', "a") as f:
-                f.write(checksum)
+            # hash the upload as we save it, so we never read it again
+            with open(artifact, 'wb') as f:
+                out = compression.DigestWriter(f)
+                for chunk in iter(lambda: upload.file.read(65536), b''):
+                    out.write(chunk)
+
+            codec = compression.detect(artifact)
+            with open(os.devnull, 'w') as fnull:
+                if call(compression.tar(codec, 't', artifact), stdout=fnull):
+                    app.log('UPLOAD', 'ERROR: not a valid tarfile:', artifact)
+                    raise
+            compression.record(artifact, codec)
+            compression.record_digests(artifact, out.digests())
             shutil.move(tmpdir, os.path.join(app.config['artifact-dir'],
                                              cache_id))
             response.status = 201  # success!
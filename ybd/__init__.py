@@ -16,10 +16,17 @@
 import app
 import assembly
 import cache
+import compression
 import defaults
+import manifests
 import morphs
+import objects
 import pots
+import publisher
 import deployment
 import repos
 import sandbox
+import scheduler
+import staging
+import uploader
 import utils
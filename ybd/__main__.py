@@ -21,15 +21,18 @@ import os
 import sys
 import fcntl
 import app
-from app import cleanup, config, log, RetryException, setup, spawn, timer
-from assembly import compose
+from app import cleanup, config, log, setup, timer
 from deployment import deploy
 from pots import Pots
 from concourse import Pipeline
+from scheduler import Scheduler
 import cache
+import publisher
+import repos
 from release_note import do_release_note
 import sandbox
 import sandboxlib
+import uploader
 import yaml
 
 
@@ -58,6 +61,11 @@ with timer('TOTAL'):
     tmp_lock = open(os.path.join(config['tmp'], 'lock'), 'r')
     fcntl.flock(tmp_lock, fcntl.LOCK_SH | fcntl.LOCK_NB)
 
+    if config.get('mode', 'normal') == 'flush-uploads':
+        with timer('UPLOADS', 'flushing the upload queue'):
+            failed = uploader.flush()
+        os._exit(1 if failed else 0)
+
     target = os.path.join(config['defdir'], config['target'])
     log('TARGET', 'Target is %s' % target, config['arch'])
     with timer('DEFINITIONS', 'parsing %s' % config['def-version']):
@@ -69,6 +77,7 @@ with timer('TOTAL'):
         os._exit(0)
 
     with timer('CACHE-KEYS', 'cache-key calculations'):
+        repos.resolve_trees(cache.components(target))
         cache.cache_key(target)
 
     if 'release-note' in config:
@@ -79,6 +88,10 @@ with timer('TOTAL'):
         log('ARCH', 'No definitions for', config['arch'], exit=True)
 
     app.defs.save_trees()
+    cache.key_index().save()
+    # the git processes which resolved the trees aren't needed any more,
+    # and the workers we are about to fork mustn't inherit their pipes
+    repos.close_objects()
     if config.get('mode', 'normal') == 'keys-only':
         write_cache_key()
         os._exit(0)
@@ -91,23 +104,30 @@ with timer('TOTAL'):
         log(config['target'], 'WARNING: using chroot is less safe ' +
             'than using linux-user-chroot')
 
-    if 'instances' in config:
-        spawn()
-
-    while True:
-        try:
-            compose(target)
-            break
-        except KeyboardInterrupt:
-            log(target, 'Interrupted by user')
-            os._exit(1)
-        except RetryException:
-            pass
-        except:
-            import traceback
-            traceback.print_exc()
-            log(target, 'Exiting: uncaught exception')
-            os._exit(1)
+    sandbox.start_jobserver()
+    scheduler = Scheduler(target)
+    try:
+        uploader.start()
+        publisher.start()
+        scheduler.start()
+        repos.prefetch(scheduler.queued())
+        scheduler.run()
+        publisher.stop()
+        uploader.stop()
+    except KeyboardInterrupt:
+        scheduler.stop(abort=True)
+        publisher.stop(abort=True)
+        uploader.stop(abort=True)
+        log(target, 'Interrupted by user')
+        os._exit(1)
+    except:
+        import traceback
+        traceback.print_exc()
+        scheduler.stop(abort=True)
+        publisher.stop(abort=True)
+        uploader.stop(abort=True)
+        log(target, 'Exiting: uncaught exception')
+        os._exit(1)
 
     if config.get('reproduce'):
         log('REPRODUCED',
@@ -115,6 +135,8 @@ with timer('TOTAL'):
         for match in config['reproduced']:
             print match[0], match[1]
 
-    if target.get('kind') == 'cluster' and config.get('fork') is None:
+    if target.get('kind') == 'cluster':
         with timer(target, 'cluster deployment'):
             deploy(target)
+
+cache.artifacts.flush()
@@ -40,24 +40,6 @@ config = {}
 defs = {}
 
 
-class RetryException(Exception):
-    def __init__(self, dn):
-        if config.get('last-retry-dn') != dn:
-            log(dn, 'Already assembling, so wait/retry', verbose=True)
-        if config.get('last-retry-time'):
-            wait = datetime.datetime.now() - config.get('last-retry-time')
-            if wait.seconds < 1:
-                with open(lockfile(dn), 'r') as L:
-                    call(['flock', '--shared', '--timeout',
-                          config.get('timeout', '60'), str(L.fileno())])
-                log(dn, 'Finished wait loop', verbose=True)
-        config['last-retry-time'] = datetime.datetime.now()
-        config['last-retry-dn'] = dn
-        for dirname in config['sandboxes']:
-            remove_dir(dirname)
-        config['sandboxes'] = []
-
-
 # Code taken from Eli Bendersky's example at
 # http://eli.thegreenplace.net/2012/01/04/shared-counter-with-pythons-multiprocessing
 class Counter(object):
@@ -141,7 +123,6 @@ def setup(args, original_cwd=""):
     log('SETUP', 'Running %s in' % args[0], os.getcwd())
     config['target'] = os.path.basename(os.path.splitext(args[1])[0])
     config['arch'] = args[2]
-    config['sandboxes'] = []
     config['overlaps'] = []
     config['new-overlaps'] = []
 
@@ -269,6 +250,9 @@ def cleanup(tmpdir):
 
 def remove_dir(tmpdir):
     if (os.path.dirname(tmpdir) == config['tmp']) and os.path.isdir(tmpdir):
+        if os.path.ismount(tmpdir):
+            # a sandbox whose build failed may still have its overlay
+            call(['umount', '-l', tmpdir])
         try:
             shutil.rmtree(tmpdir)
         except:
@@ -319,11 +303,3 @@ def elapsed(starttime):
     hours, remainder = divmod(int(td.total_seconds()), 60*60)
     minutes, seconds = divmod(remainder, 60)
     return "%02d:%02d:%02d" % (hours, minutes, seconds)
-
-
-def spawn():
-    for fork in range(1, config.get('instances')):
-        if os.fork() == 0:
-            config['fork'] = fork
-            log('FORKS', 'I am fork', config.get('fork'))
-            break
@@ -15,19 +15,18 @@
 # =*= License: GPL-2 =*=
 
 import os
-import random
 import contextlib
 import fcntl
 import errno
 
 import app
 from app import config, timer, elapsed
-from app import log, log_riemann, lockfile, RetryException
-from cache import cache, cache_key, get_cache, get_remote
+from app import log, log_riemann, lockfile
+from cache import cache, cache_key, get_cache, get_remote, wait_for_artifact
 import repos
 import sandbox
-import datetime
 from splitting import write_metadata, install_split_artifacts
+from splitting import keep_split_artifacts
 
 
 def compose(dn):
@@ -52,6 +51,8 @@ def compose(dn):
     # if we have a kbas, look there to see if this component exists
     if config.get('kbas-url') and not config.get('reproduce'):
         with claim(dn):
+            if get_cache(dn):
+                return cache_key(dn)
             if get_remote(dn):
                 config['counter'].increment()
                 return cache_key(dn)
@@ -61,9 +62,7 @@ def compose(dn):
         return None
 
     # Create composite components (strata, systems, clusters)
-    systems = dn.get('systems', [])
-    shuffle(systems)
-    for system in systems:
+    for system in dn.get('systems', []):
         for s in system.get('subsystems', []):
             subsystem = app.defs.get(s['path'])
             compose(subsystem)
@@ -76,6 +75,18 @@ def compose(dn):
     return cache_key(dn)
 
 
+def fetch(dn):
+    '''Download dn from kbas, unless another instance creates it first.'''
+
+    with claim(dn):
+        if get_cache(dn):
+            return True
+        if get_remote(dn):
+            config['counter'].increment()
+            return True
+    return False
+
+
 def install_contents(dn, contents=None):
     ''' Install contents (recursively) into dn['sandbox'] '''
 
@@ -84,11 +95,9 @@ def install_contents(dn, contents=None):
 
     log(dn, 'Installing contents\n', contents, verbose=True)
 
-    shuffle(contents)
     for it in contents:
         item = app.defs.get(it)
-        if os.path.exists(os.path.join(dn['sandbox'],
-                                       'baserock', item['name'] + '.meta')):
+        if sandbox.installed(dn, item):
             # content has already been installed
             log(dn, 'Already installed', item['name'], verbose=True)
             continue
@@ -99,7 +108,9 @@ def install_contents(dn, contents=None):
         if item.get('build-mode', 'staging') != 'bootstrap':
             if not get_cache(item):
                 compose(item)
-            sandbox.install(dn, item)
+            if dn.get('kind') != 'system':
+                # systems install only the splits they keep, in build()
+                sandbox.install(dn, item)
 
     if config.get('log-verbose'):
         log(dn, 'Added contents\n', contents)
@@ -113,11 +124,9 @@ def install_dependencies(dn, dependencies=None):
         dependencies = dn.get('build-depends', [])
 
     log(dn, 'Installing dependencies\n', dependencies, verbose=True)
-    shuffle(dependencies)
     for it in dependencies:
         dependency = app.defs.get(it)
-        if os.path.exists(os.path.join(dn['sandbox'], 'baserock',
-                                       dependency['name'] + '.meta')):
+        if sandbox.installed(dn, dependency):
             # dependency has already been installed
             log(dn, 'Already did', dependency['name'], verbose=True)
             continue
@@ -141,15 +150,22 @@ def build(dn):
         return
 
     with claim(dn):
+        if get_cache(dn):
+            # another instance published dn while we were waiting for it
+            return
+
         if dn.get('kind', 'chunk') == 'chunk':
             install_dependencies(dn)
+        elif dn.get('kind') == 'system':
+            kept = install_split_artifacts(dn)
         with timer(dn, 'build of %s' % dn['cache']):
-            run_build(dn)
+            with sandbox.stage_dependencies(dn):
+                run_build(dn)
 
         with timer(dn, 'artifact creation'):
 
             if dn.get('kind', 'chunk') == 'system':
-                install_split_artifacts(dn)
+                keep_split_artifacts(dn, kept)
 
             write_metadata(dn)
             cache(dn)
@@ -170,7 +186,7 @@ def run_build(dn):
 
     if dn.get('repo'):
         repos.checkout(dn)
-        dn['SOURCE_DATE_EPOCH'] = repos.source_date_epoch(dn['checkout'])
+        dn['SOURCE_DATE_EPOCH'] = repos.source_date_epoch(dn)
 
     get_build_commands(dn)
     env_vars = sandbox.env_vars_for_build(dn)
@@ -193,31 +209,43 @@ def run_build(dn):
         log_riemann(dn, 'Artifact_Timer', dn['name'], time_elapsed)
 
 
-def shuffle(contents):
-    if config.get('instances', 1) > 1:
-        random.seed(datetime.datetime.now())
-        random.shuffle(contents)
-
-
 @contextlib.contextmanager
 def claim(dn):
-    with open(lockfile(dn), 'a') as L:
-        try:
-            fcntl.flock(L, fcntl.LOCK_EX | fcntl.LOCK_NB)
-        except Exception as e:
-            if e.errno in (errno.EACCES, errno.EAGAIN):
+    '''Hold the lock on dn, waiting for any other instance to finish with it.
+
+    Callers must check whether the artifact exists once they have the claim,
+    because the instance we waited for has most likely just created it.
+
+    '''
+    while True:
+        with open(lockfile(dn), 'a') as L:
+            try:
+                fcntl.flock(L, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except Exception as e:
+                if e.errno not in (errno.EACCES, errno.EAGAIN):
+                    log(dn, 'ERROR: surprise exception in assembly', '')
+                    import traceback
+                    traceback.print_exc()
+                    log(dn, 'Sandbox debris at', dn.get('sandbox'), exit=True)
                 # flock() will report EACCESS or EAGAIN when the lock fails.
-                raise RetryException(dn)
-            else:
-                log(dn, 'ERROR: surprise exception in assembly', '')
-                import traceback
-                traceback.print_exc()
-                log(dn, 'Sandbox debris at', dn['sandbox'], exit=True)
-        try:
-            yield
-        finally:
-            if os.path.isfile(lockfile(dn)):
-                os.remove(lockfile(dn))
+                log(dn, 'Waiting for another instance to assemble',
+                    cache_key(dn))
+                wait_for_artifact(dn, L)
+                fcntl.flock(L, fcntl.LOCK_EX)
+
+            try:
+                if os.fstat(L.fileno()).st_ino != os.stat(lockfile(dn)).st_ino:
+                    continue
+            except OSError:
+                # the lockfile was removed by the instance we waited for
+                continue
+
+            try:
+                yield
+            finally:
+                if os.path.isfile(lockfile(dn)):
+                    os.remove(lockfile(dn))
+            return
 
 
 def get_build_commands(dn):
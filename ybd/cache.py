@@ -16,13 +16,24 @@
 
 import requests
 
+import errno
+import fcntl
 import hashlib
 import json
 import os
+import select
 import shutil
-from subprocess import call
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+from subprocess import call, PIPE, Popen
 
 import app
+import compression
+import manifests
+import objects
+import publisher
+import staging
 from repos import get_repo_url, get_tree
 import utils
 import tempfile
@@ -30,6 +41,11 @@ import yaml
 import re
 
 
+# shared by all downloads in this process, to honour download-limit
+_bandwidth = None
+_bandwidth_lock = threading.Lock()
+
+
 def cache_key(dn):
     if dn is None:
         app.log(dn, 'No definition found for', dn, exit=True)
@@ -56,9 +72,15 @@ def cache_key(dn):
     if app.config.get('mode', 'normal') in ['keys-only', 'normal']:
         if dn.get('repo') and not dn.get('tree'):
             dn['tree'] = get_tree(dn)
-        factors = hash_factors(dn)
-        factors = json.dumps(factors, sort_keys=True).encode('utf-8')
-        key = hashlib.sha256(factors).hexdigest()
+        factors = own_factors(dn)
+        dependencies = dependency_factors(dn)
+        index = key_index().digest(dn, factors, dependencies)
+        key = key_index().get(index)
+        if key is None:
+            factors.update(dependencies)
+            factors = json.dumps(factors, sort_keys=True).encode('utf-8')
+            key = hashlib.sha256(factors).hexdigest()
+            key_index().put(index, key)
 
     dn['cache'] = dn['name'] + "." + key
 
@@ -84,15 +106,70 @@ def cache_key(dn):
     return dn['cache']
 
 
+def components(dn):
+    '''Return all definitions whose cache-keys are needed for dn.
+
+    This follows the same recursion as hash_factors(), so that any work they
+    need (eg resolving git trees) can be done in bulk before hashing.
+
+    '''
+    found = {}
+
+    def walk(dn):
+        dn = app.defs.get(dn)
+        if dn['path'] in found:
+            return
+        found[dn['path']] = dn
+        if dn.get('arch', app.config['arch']) != app.config['arch']:
+            return
+        for it in dn.get('build-depends', []) + dn.get('contents', []):
+            walk(it)
+        for system in dn.get('systems', []):
+            walk_systems(system)
+
+    def walk_systems(system):
+        walk(system.get('path', 'BROKEN'))
+        for subsystem in system.get('subsystems', []):
+            walk_systems(subsystem)
+
+    walk(dn)
+    return found.values()
+
+
 def hash_factors(dn):
-    hash_factors = {'arch': app.config['arch']}
+    hash_factors = own_factors(dn)
+    hash_factors.update(dependency_factors(dn))
+    return hash_factors
+
 
+def dependency_factors(dn):
+    '''Return the cache-keys of everything dn's own cache-key depends on.'''
+
+    hash_factors = {}
     for factor in dn.get('build-depends', []):
         hash_factors[factor] = cache_key(factor)
 
     for factor in dn.get('contents', []):
         hash_factors[factor.keys()[0]] = cache_key(factor.keys()[0])
 
+    def hash_system_recursively(system):
+        factor = system.get('path', 'BROKEN')
+        hash_factors[factor] = cache_key(factor)
+        for subsystem in system.get('subsystems', []):
+            hash_system_recursively(subsystem)
+
+    if dn.get('kind') == 'cluster':
+        for system in dn.get('systems', []):
+            hash_system_recursively(system)
+
+    return hash_factors
+
+
+def own_factors(dn):
+    '''Return the factors of dn's cache-key which come from dn itself.'''
+
+    hash_factors = {'arch': app.config['arch']}
+
     relevant_factors = ['tree', 'submodules'] + app.defs.defaults.build_steps
     if app.config.get('artifact-version', False) not in range(0, 6):
         relevant_factors += ['devices']
@@ -105,16 +182,6 @@ def hash_factors(dn):
         if app.config.get('default-splits', []) != []:
             hash_factors['splits'] = app.config.get('default-splits')
 
-    def hash_system_recursively(system):
-        factor = system.get('path', 'BROKEN')
-        hash_factors[factor] = cache_key(factor)
-        for subsystem in system.get('subsystems', []):
-            hash_system_recursively(subsystem)
-
-    if dn.get('kind') == 'cluster':
-        for system in dn.get('systems', []):
-            hash_system_recursively(system)
-
     if app.config.get('artifact-version', False):
         hash_factors['artifact-version'] = app.config.get('artifact-version')
 
@@ -141,32 +208,104 @@ def hash_factors(dn):
     return hash_factors
 
 
+class KeyIndex(object):
+    '''Cache-keys from previous runs, so we can avoid recalculating them.
+
+    With artifact-version 1 every cache-key includes all of the default
+    build-systems, so serialising them dominates the time taken to hash.
+    Here they are reduced to a digest once per run, and entries are indexed
+    by a digest of the definition's name, its own hash factors and the
+    cache-keys of its dependencies. So a change to one definition only
+    misses for it and the components which depend on it.
+
+    For other artifact-versions the index digest would cost as much as the
+    key itself, so the index isn't used.
+
+    '''
+
+    limit = 100000
+
+    def __init__(self):
+        self._file = os.path.join(app.config['artifacts'], '.keys')
+        self._data = self._load()
+        self._used = {}
+        self._shared = None
+        self._hits = 0
+
+    def _load(self):
+        try:
+            with open(self._file) as f:
+                return json.load(f)
+        except:
+            return {}
+
+    def digest(self, dn, factors, dependencies):
+        '''Return the index entry for dn, or None if it isn't worth one.'''
+
+        blob = app.defs.defaults.build_systems
+        if factors.get('default-build-systems') is not blob:
+            return None
+        if self._shared is None:
+            text = json.dumps(blob, sort_keys=True).encode('utf-8')
+            self._shared = hashlib.sha256(text).hexdigest()
+        own = dict(factors)
+        own['default-build-systems'] = self._shared
+        text = json.dumps([dn['name'], own, dependencies], sort_keys=True)
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    def get(self, index):
+        key = self._data.get(index)
+        if key is not None:
+            key = str(key)
+            self._used[index] = key
+            self._hits += 1
+        return key
+
+    def put(self, index, key):
+        if index is not None:
+            self._data[index] = self._used[index] = key
+
+    def save(self):
+        '''Merge our entries with the file, which may have changed.'''
+
+        if not self._used:
+            return
+        app.log('CACHE-KEYS', 'Re-used %s entries from cache-key index' %
+                self._hits)
+        data = self._load()
+        if len(data) + len(self._used) > self.limit:
+            # too big, so keep only what this run needed
+            data = {}
+        if all(data.get(i) == k for i, k in self._used.items()):
+            return
+        data.update(self._used)
+        tempfile.tempdir = app.config['tmp']
+        fd, tmpfile = tempfile.mkstemp()
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.rename(tmpfile, self._file)
+
+
+_key_index = None
+
+
+def key_index():
+    global _key_index
+    if _key_index is None:
+        _key_index = KeyIndex()
+    return _key_index
+
+
 def cache(dn):
     if get_cache(dn):
         app.log(dn, "Bah! I could have cached", cache_key(dn))
         return
-    tempfile.tempdir = app.config['tmp']
-    tmpdir = tempfile.mkdtemp()
-    cachefile = os.path.join(tmpdir, cache_key(dn))
     if dn.get('kind') == "system":
-        utils.hardlink_all_files(dn['install'], dn['sandbox'])
         shutil.rmtree(dn['checkout'])
-        utils.set_mtime_recursively(dn['install'])
-        utils.make_deterministic_tar_archive(cachefile, dn['install'])
-        shutil.move('%s.tar' % cachefile, cachefile)
-    else:
-        utils.set_mtime_recursively(dn['install'])
-        utils.make_deterministic_gztar_archive(cachefile, dn['install'])
-        shutil.move('%s.tar.gz' % cachefile, cachefile)
-
-    unpack(dn, cachefile)
-    app.config['counter'].increment()
 
-    if app.config.get('kbas-password', 'insecure') != 'insecure' and \
-            app.config.get('kbas-url') is not None:
-        if dn.get('kind', 'chunk') in app.config.get('kbas-upload', 'chunk'):
-            with app.timer(dn, 'upload'):
-                upload(dn)
+    # the tarball is created (and uploaded) in the background, or on demand
+    publisher.publish(dn)
+    app.config['counter'].increment()
 
 
 def update_manifest(dn, manifest):
@@ -177,7 +316,7 @@ def update_manifest(dn, manifest):
                               get_repo_url(dn.get('repo', 'None')),
                               dn.get('ref', 'None'),
                               dn.get('unpetrify-ref', 'None'),
-                              md5(get_cache(dn))))
+                              md5(get_archive(dn))))
             m.flush()
             return
 
@@ -186,100 +325,303 @@ def update_manifest(dn, manifest):
                             'repo': get_repo_url(dn.get('repo', None)),
                             'sha': dn.get('ref', None),
                             'ref': dn.get('unpetrify-ref', None),
-                            'md5': md5(get_cache(dn))}}
+                            'md5': md5(get_archive(dn))}}
         m.write(yaml.dump(text, default_flow_style=True))
         m.flush()
 
 
-def unpack(dn, tmpfile):
-    if dn.get('kind') != 'system':
-        unpackdir = tmpfile + '.unpacked'
-        os.makedirs(unpackdir)
-        if call(['tar', 'xf', tmpfile, '--directory', unpackdir]):
-            app.log(dn, 'Problem unpacking', tmpfile, exit=True)
-    else:
-        with open(os.devnull, "w") as fnull:
-            if call(['tar', 'tvf', tmpfile], stdout=fnull, stderr=fnull):
-                app.log(dn, 'Problem with tarfile', tmpfile, exit=True)
+def store(dn, tmpfile):
+    '''Move the directory holding tmpfile, and its unpacked tree, in place.
+
+    Returns the artifact's path, or False if another instance got there
+    first.
 
+    '''
+    unpackdir = tmpfile + '.unpacked'
+    if os.path.isdir(unpackdir):
+        # before it's published, as in publisher.publish()
+        objects.add(unpackdir, manifests.write(unpackdir))
+    path = os.path.join(app.config['artifacts'], cache_key(dn))
     try:
-        path = os.path.join(app.config['artifacts'], cache_key(dn))
-        shutil.move(os.path.dirname(tmpfile), path)
-        if not os.path.isdir(path):
-            app.log(dn, 'Problem creating artifact', path, exit=True)
-
-        size = os.path.getsize(get_cache(dn))
-        size = re.sub("(\d)(?=(\d{3})+(?!\d))", r"\1,", "%d" % size)
-        checksum = md5(get_cache(dn))
-        app.log(dn, 'Cached %s bytes %s as' % (size, checksum), cache_key(dn))
-        return path
-    except:
+        os.rename(os.path.dirname(tmpfile), path)
+    except OSError as e:
+        if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+            raise
         app.log(dn, 'Bah! I raced on', cache_key(dn))
         shutil.rmtree(os.path.dirname(tmpfile))
         return False
+    artifacts.published(cache_key(dn))
+
+    record_access(cache_key(dn), utils.tree_size(path))
+    size = os.path.getsize(get_cache(dn))
+    size = re.sub("(\d)(?=(\d{3})+(?!\d))", r"\1,", "%d" % size)
+    checksum = md5(get_cache(dn))
+    app.log(dn, 'Cached %s bytes %s as' % (size, checksum), cache_key(dn))
+    return path
 
 
 def upload(dn):
-    cachefile = get_cache(dn)
+    '''Upload dn to kbas. Returns False if the upload is worth retrying.'''
+
+    cachefile = get_archive(dn)
+    if not cachefile:
+        app.log(dn, 'WARNING: no artifact to upload for', dn['cache'])
+        return True
     url = app.config['kbas-url'] + 'upload'
+    checksum = md5(cachefile)
     params = {"filename": dn['cache'],
               "password": app.config['kbas-password'],
-              "checksum": md5(cachefile)}
+              "checksum": checksum}
     with open(cachefile, 'rb') as f:
         try:
             response = requests.post(url=url, data=params, files={"file": f})
             if response.status_code == 201:
                 app.log(dn, 'Uploaded %s to kbas' % dn['cache'])
-                return
+                return True
             if response.status_code == 777:
-                app.log(dn, 'Reproduced %s at' % md5(cachefile), dn['cache'])
-                app.config['reproduced'].append([md5(cachefile), dn['cache']])
-                return
+                app.log(dn, 'Reproduced %s at' % checksum, dn['cache'])
+                app.config['reproduced'].append([checksum, dn['cache']])
+                return True
             if response.status_code == 405:
                 # server has different md5 for this artifact
-                if dn['kind'] == 'stratum' and app.config['reproduce']:
+                if dn['kind'] == 'stratum' and app.config.get('reproduce'):
                     app.log('BIT-FOR-BIT',
                             'WARNING: reproduction failed for', dn['cache'])
                 app.log(dn, 'Artifact server already has', dn['cache'])
-                return
+                return True
+            if response.status_code in (400, 409, 413):
+                # the upload itself is at fault, so trying again won't help
+                app.log(dn, 'WARNING: artifact server refused',
+                        (dn['cache'], response.status_code))
+                return True
+            if response.status_code in (401, 403):
+                # keep it queued, for when kbas-password has been fixed
+                app.log(dn, 'WARNING: artifact server refused our password, '
+                        'check kbas-password. Keeping queued',
+                        (dn['cache'], response.status_code))
+                return False
             app.log(dn, 'Artifact server problem:', response.status_code)
         except:
             pass
         app.log(dn, 'Failed to upload', dn['cache'])
+        return False
+
+
+class ArtifactCache(object):
+    '''Which artifacts are in the artifacts directory, as far as we know.
+
+    Artifacts don't change once they are published, so once we have seen
+    one we remember it for the rest of the process. Artifacts we found to
+    be missing are remembered until anything new appears in the artifacts
+    directory, which inotify tells us about, including artifacts published
+    by other workers and instances. Without inotify, we always look again.
+
+    Uses of artifacts are collected, and written to the access log by
+    flush().
+
+    '''
+
+    def __init__(self):
+        self._pid = None
+        self._watch = None
+        self._lock = None
+        self._generation = 0
+        self._present = set()
+        self._missing = {}
+        self._used = set()
+        self._recorded = set()
+
+    def _refresh(self):
+        if self._pid != os.getpid():
+            # a forked process has to have its own watch and log entries
+            if self._watch is not None:
+                os.close(self._watch)
+            self._watch = utils.watch_directory(app.config['artifacts'])
+            self._missing = {}
+            self._used = set()
+            self._recorded = set()
+            self._pid = os.getpid()
+            self._lock = threading.Lock()
+        elif self._watch is not None:
+            # reading the events and counting them must look like one step
+            # to other threads, or they could go on to trust stale misses
+            with self._lock:
+                if select.select([self._watch], [], [], 0)[0]:
+                    os.read(self._watch, 65536)
+                    self._generation += 1
+
+    def get(self, key):
+        '''Return the path of artifact key, or False if we don't have it.'''
+
+        self._refresh()
+        path = os.path.join(app.config['artifacts'], key, key)
+        if key in self._present:
+            return path
+        if self._watch is not None and \
+                self._missing.get(key) == self._generation:
+            return False
+        if os.path.isdir(os.path.dirname(path)):
+            self._present.add(key)
+            self._missing.pop(key, None)
+            return path
+        self._missing[key] = self._generation
+        return False
+
+    def published(self, key):
+        self._present.add(key)
+        self._missing.pop(key, None)
+
+    def removed(self, key):
+        self._present.discard(key)
+
+    def used(self, key):
+        if key not in self._recorded:
+            self._used.add(key)
+
+    def flush(self):
+        '''Write the uses we have collected to the access log.'''
+
+        if self._pid == os.getpid() and self._used:
+            log_access([(key, None) for key in sorted(self._used)])
+            self._recorded.update(self._used)
+            self._used = set()
+
+
+artifacts = ArtifactCache()
 
 
 def get_cache(dn):
-    ''' Check if a cached artifact exists for the hashed version of d. '''
+    ''' Check if a cached artifact exists for the hashed version of d.
+
+    This is only a check for the artifact's directory, and the answer is
+    usually already known, so it is cheap enough to call for every
+    component. Use get_unpacked() to actually use it.
 
+    '''
     if cache_key(dn) is False:
         return False
 
-    cachedir = os.path.join(app.config['artifacts'], cache_key(dn))
-    if os.path.isdir(cachedir):
-        call(['touch', cachedir])
-        artifact = os.path.join(cachedir, cache_key(dn))
-        unpackdir = artifact + '.unpacked'
-        if not os.path.isdir(unpackdir) and dn.get('kind') != 'system':
-            tempfile.tempdir = app.config['tmp']
-            tmpdir = tempfile.mkdtemp()
-            if call(['tar', 'xf', artifact, '--directory', tmpdir]):
-                app.log(dn, 'Problem unpacking', artifact)
-                return False
+    return artifacts.get(cache_key(dn))
+
+
+def get_archive(dn):
+    '''Return the path to dn's tarball, creating it if need be.'''
+
+    artifact = get_cache(dn)
+    if not artifact:
+        return False
+    if not os.path.exists(artifact):
+        publisher.archive(dn['cache'], dn.get('kind', 'chunk'))
+        record_access(dn['cache'], utils.tree_size(os.path.dirname(artifact)))
+    return artifact if os.path.exists(artifact) else False
+
+
+def get_unpacked(dn):
+    '''Return the path to dn's unpacked artifact, unpacking it if need be.'''
+
+    artifact = get_cache(dn)
+    if not artifact:
+        return False
+
+    # mark the artifact as recently used, so cull() keeps it longer
+    artifacts.used(dn['cache'])
+    unpackdir = artifact + '.unpacked'
+    if not os.path.isdir(unpackdir):
+        tempfile.tempdir = app.config['tmp']
+        tmpdir = tempfile.mkdtemp()
+        unpacked = os.path.join(tmpdir, os.path.basename(unpackdir))
+        os.mkdir(unpacked)
+        codec = compression.detect(artifact)
+        if call(compression.tar(codec, 'x', artifact, '--directory',
+                                unpacked)):
+            app.log(dn, 'Problem unpacking', artifact)
+            shutil.rmtree(tmpdir, ignore_errors=True)
+            return False
+        # before it's published, as in publisher.publish()
+        objects.add(unpacked, manifests.write(unpacked))
+        manifest = os.path.join(tmpdir, dn['cache'] + '.manifest')
+        try:
+            if os.path.exists(manifest):
+                os.rename(manifest, artifact + '.manifest')
+            os.rename(unpacked, unpackdir)
+        except OSError:
+            # corner case... if we are here ybd is multi-instance, this
+            # artifact was uploaded from somewhere, and more than one
+            # instance is attempting to unpack. another got there first
+            shutil.rmtree(tmpdir, ignore_errors=True)
+            return unpackdir
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        record_access(dn['cache'], utils.tree_size(os.path.dirname(artifact)))
+    return unpackdir
+
+
+def wait_for_artifact(dn, lock):
+    '''Wait until another instance publishes dn or gives up its claim.
+
+    inotify wakes us as soon as anything is moved into the artifacts dir. We
+    also poll the claim, in case the other instance fails without publishing.
+
+    '''
+    watch = utils.watch_directory(app.config['artifacts'])
+    try:
+        while not get_cache(dn):
             try:
-                shutil.move(tmpdir, unpackdir)
-            except:
-                # corner case... if we are here ybd is multi-instance, this
-                # artifact was uploaded from somewhere, and more than one
-                # instance is attempting to unpack. another got there first
-                pass
-        return artifact
+                fcntl.flock(lock, fcntl.LOCK_SH | fcntl.LOCK_NB)
+                app.log(dn, 'WARNING: other instance gave up on', dn['cache'])
+                return
+            except IOError as e:
+                if e.errno not in (errno.EACCES, errno.EAGAIN):
+                    raise
+            if watch is None:
+                time.sleep(1)
+            elif select.select([watch], [], [], 1)[0]:
+                os.read(watch, 65536)
+    finally:
+        if watch is not None:
+            os.close(watch)
+    app.log(dn, 'Finished waiting for', dn['cache'])
+
+
+def find_remote(keys):
+    '''Return the set of keys which kbas has artifacts for.'''
+
+    url = app.config['kbas-url']
+    found = set()
+    try:
+        for i in range(0, len(keys), 500):
+            response = requests.post(url=url + 'exists', json=keys[i:i + 500],
+                                     timeout=60)
+            if response.status_code != 200:
+                break
+            found.update(response.json()['artifacts'])
+        else:
+            return found
+    except:
+        app.log('KBAS', 'WARNING: remote artifact server is not working')
+        return set()
 
-    return False
+    # older kbas has no /exists, so we have to ask about each artifact
+    def exists(key):
+        try:
+            response = requests.head(url=url + 'get/' + key, timeout=60)
+            return response.status_code == 200
+        except:
+            return False
+
+    pool = ThreadPool(app.config.get('download-jobs', 4))
+    try:
+        found = pool.map(exists, keys)
+    finally:
+        pool.close()
+        pool.join()
+    return set(key for key, present in zip(keys, found) if present)
 
 
 def get_remote(dn):
     ''' If a remote cached artifact exists for d, retrieve it '''
-    if app.config.get('last-retry-component') == dn or dn.get('tried'):
+    global _bandwidth
+
+    if dn.get('tried'):
         return False
 
     dn['tried'] = True  # let's not keep asking for this artifact
@@ -290,91 +632,254 @@ def get_remote(dn):
     try:
         app.log(dn, 'Try downloading', cache_key(dn))
         url = app.config['kbas-url'] + 'get/' + cache_key(dn)
-        response = requests.get(url=url, stream=True)
+        response = requests.get(url=url, stream=True, timeout=60)
     except:
-        app.config.pop('kbas-url')
+        app.config.pop('kbas-url', None)
         app.log(dn, 'WARNING: remote artifact server is not working')
         return False
 
     if response.status_code == 200:
+        with _bandwidth_lock:
+            if _bandwidth is None:
+                limit = app.config.get('download-limit', 0)
+                _bandwidth = utils.TokenBucket(limit * 1000000)
+        tempfile.tempdir = app.config['tmp']
+        tmpdir = tempfile.mkdtemp()
         try:
-            tempfile.tempdir = app.config['tmp']
-            tmpdir = tempfile.mkdtemp()
-            cachefile = os.path.join(tmpdir, cache_key(dn))
-            with open(cachefile, 'wb') as f:
-                f.write(response.content)
-
-            return unpack(dn, cachefile)
-
+            checksum = download(dn, response, tmpdir)
         except:
             app.log(dn, 'WARNING: failed downloading', cache_key(dn))
+            checksum = None
+        if checksum:
+            return store(dn, os.path.join(tmpdir, cache_key(dn)))
+        shutil.rmtree(tmpdir, ignore_errors=True)
 
     return False
 
 
-def cull(artifact_dir):
+def download(dn, response, tmpdir):
+    '''Save the artifact in response to tmpdir, unpacking it as it arrives.
+
+    Returns the md5 checksum of the artifact, or None if there was a problem.
+
+    '''
+    cachefile = os.path.join(tmpdir, cache_key(dn))
+    codec = response.headers.get('X-Codec')
+    tar = None
+    try:
+        with open(cachefile, 'wb') as f:
+            out = compression.DigestWriter(f)
+            for chunk in response.iter_content(chunk_size=65536):
+                if not chunk:
+                    continue
+                if codec not in compression.CODECS:
+                    # older kbas doesn't say, so look at the data
+                    codec = compression.identify(chunk)
+                if tar is None and dn.get('kind') != 'system':
+                    os.makedirs(cachefile + '.unpacked')
+                    tar = Popen(compression.tar(codec, 'x', '-', '--directory',
+                                                cachefile + '.unpacked'),
+                                stdin=PIPE)
+                _bandwidth.consume(len(chunk))
+                out.write(chunk)
+                if tar:
+                    tar.stdin.write(chunk)
+        compression.record(cachefile, codec or 'none')
+        compression.record_digests(cachefile, out.digests())
+    finally:
+        if tar:
+            try:
+                tar.stdin.close()
+            except IOError:
+                pass
+            if tar.wait():
+                app.log(dn, 'WARNING: problem unpacking', cache_key(dn))
+                return None
+
+    digests = out.digests()
+    for name in compression.DIGESTS:
+        expected = response.headers.get('X-Checksum-' + name.upper())
+        if expected and expected != digests[name]:
+            app.log(dn, 'WARNING: bad %s checksum %s, expected' %
+                    (name, digests[name]), expected)
+            return None
+    return digests['md5']
+
+
+def record_access(key, size):
+    '''Note that artifact key has just been used, and its size.'''
+
+    log_access([(key, size)])
+
+
+def log_access(entries):
+    '''Append uses of artifacts, as (key, size or None), to the access log.
+
+    Uses are appended to artifacts/.access in a single write, so any number
+    of ybd processes can record uses without locking. cull() reads the log
+    in one go, and rewrites it with one line per artifact.
+
+    '''
+    now = time.time()
+    text = ''.join('%d %s %s\n' % (now, key, '-' if size is None else size)
+                   for key, size in entries)
+    fd = os.open(os.path.join(app.config['artifacts'], '.access'),
+                 os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, text)
+    finally:
+        os.close(fd)
+
+
+def _read_access(artifact_dir):
+    '''Return a dict of key -> [last used, size] from the access log.'''
+
+    entries = {}
+    try:
+        with open(os.path.join(artifact_dir, '.access')) as f:
+            for line in f:
+                try:
+                    used, key, size = line.split()
+                    entry = entries.setdefault(key, [0, None])
+                    entry[0] = max(entry[0], int(used))
+                    if size != '-':
+                        entry[1] = int(size)
+                except ValueError:
+                    # a line cut short by a crash
+                    pass
+    except IOError:
+        pass
+    return entries
+
+
+def _write_access(artifact_dir, entries):
+    # uses recorded while we were culling are lost, which only makes those
+    # artifacts look a bit older than they are
     tempfile.tempdir = app.config['tmp']
-    deleted = 0
+    fd, tmpfile = tempfile.mkstemp()
+    with os.fdopen(fd, 'w') as f:
+        for key, (used, size) in sorted(entries.items()):
+            f.write('%d %s %s\n' % (used, key, '-' if size is None else size))
+    os.rename(tmpfile, os.path.join(artifact_dir, '.access'))
 
-    def clear(deleted, artifact_dir):
-        artifacts = utils.sorted_ls(artifact_dir)
-        for artifact in artifacts:
-            stat = os.statvfs(artifact_dir)
-            free = stat.f_frsize * stat.f_bavail / 1000000000
-            if free >= app.config.get('min-gigabytes', 10):
-                app.log('SETUP', '%sGB is enough free space' % free)
-                if deleted > 0:
-                    app.log('SETUP', 'Culled %s items in' % deleted,
-                            artifact_dir)
-                return True
-            path = os.path.join(artifact_dir, artifact)
-            if os.path.exists(os.path.join(path, artifact + '.unpacked')):
-                path = os.path.join(path, artifact + '.unpacked')
-            if os.path.exists(path) and artifact not in app.config['keys']:
-                tmpdir = tempfile.mkdtemp()
-                shutil.move(path, os.path.join(tmpdir, 'to-delete'))
-                app.remove_dir(tmpdir)
-                deleted += 1
-        return False
 
-    # cull unpacked dirs first
-    if clear(deleted, artifact_dir):
-        return
+def _free(artifact_dir):
+    stat = os.statvfs(artifact_dir)
+    return stat.f_frsize * stat.f_bavail
+
+
+def cull(artifact_dir):
+    '''Remove artifacts until there are min-gigabytes free.
+
+    Unpacked trees go first, since their tarball is kept, then whole
+    artifacts. Within each, large artifacts which have not been used for a
+    long time go first. Artifacts needed for the current target are never
+    removed.
 
-    # cull artifacts
-    if clear(deleted, artifact_dir):
+    '''
+    tempfile.tempdir = app.config['tmp']
+    target = app.config.get('min-gigabytes', 10) * 1000000000
+    if _free(artifact_dir) < target:
+        # staging snapshots link to artifacts' files, and the object store
+        # has files left by artifacts removed elsewhere
+        staging.evict()
+        objects.collect()
+    free = _free(artifact_dir)
+    if free >= target:
+        app.log('SETUP', '%sGB is enough free space' % (free / 1000000000))
         return
 
-    stat = os.statvfs(artifact_dir)
-    free = stat.f_frsize * stat.f_bavail / 1000000000
-    if free < app.config.get('min-gigabytes', 10):
-        app.log('SETUP', '%sGB is less than min-gigabytes:' % free,
-                app.config.get('min-gigabytes', 10), exit=True)
+    entries = _read_access(artifact_dir)
+    now = time.time()
+    keys = set(app.config['keys'])
+    candidates = []
+    for artifact in os.listdir(artifact_dir):
+        if artifact.startswith('.') or artifact in keys or \
+                os.path.exists(os.path.join(artifact_dir, '.pending',
+                                            artifact)):
+            # skip our own files, artifacts we need, and artifacts still
+            # being archived
+            continue
+        path = os.path.join(artifact_dir, artifact)
+        entry = entries.setdefault(artifact, [None, None])
+        if entry[0] is None:
+            # not used since the access log started
+            entry[0] = int(os.lstat(path).st_mtime)
+        size = entry[1]
+        if size is None:
+            # walking every artifact would take far too long, so estimate
+            # from its tarball, and only measure what we actually remove
+            tarball = os.path.join(path, artifact)
+            size = os.lstat(tarball if os.path.exists(tarball)
+                            else path).st_size
+        cost = (now - entry[0] + 1) * size
+        unpackdir = os.path.join(path, artifact + '.unpacked')
+        if os.path.exists(unpackdir) and \
+                os.path.exists(os.path.join(path, artifact)):
+            candidates.append((0, -cost, artifact, unpackdir))
+        candidates.append((1, -cost, artifact, path))
+
+    stored = {}
+
+    def remove(path):
+        # files shared with other artifacts only free space in the object
+        # store once nothing else links to them
+        inodes = objects.shared(path)
+        tmpdir = tempfile.mkdtemp()
+        shutil.move(path, os.path.join(tmpdir, 'to-delete'))
+        app.remove_dir(tmpdir)
+        artifacts.removed(os.path.basename(path))
+        if inodes:
+            if not stored:
+                stored.update(objects.index())
+            objects.release(inodes, stored)
+
+    # we estimate the space freed from the sizes in the log, and only check
+    # the filesystem when the estimate says we're done
+    deleted = 0
+    needed = target - free
+    for phase, cost, artifact, path in sorted(candidates):
+        if needed <= 0:
+            needed = target - _free(artifact_dir)
+            if needed <= 0:
+                break
+        if not os.path.exists(path):
+            continue
+        size = entries[artifact][1]
+        if size is None:
+            size = utils.tree_size(path)
+        remove(path)
+        deleted += 1
+        needed -= size
+        if phase == 1:
+            del entries[artifact]
+        else:
+            entries[artifact][1] = utils.tree_size(os.path.dirname(path))
+
+    _write_access(artifact_dir, entries)
+    if deleted > 0:
+        app.log('SETUP', 'Culled %s items in' % deleted, artifact_dir)
+    free = _free(artifact_dir)
+    if free < target:
+        app.log('SETUP', '%sGB is less than min-gigabytes:' %
+                (free / 1000000000), app.config.get('min-gigabytes', 10),
+                exit=True)
+    app.log('SETUP', '%sGB is enough free space' % (free / 1000000000))
 
 
 def check(artifact):
-    try:
-        artifact = os.path.join(app.config['artifact-dir'], artifact,
-                                artifact)
-        checkfile = artifact + '.md5'
-        if not os.path.exists(checkfile):
-            checksum = md5(artifact)
-            with open(checkfile, "w") as f:
-                f.write(checksum)
-
-        return(open(checkfile).read())
-    except:
-        return('================================')
+    artifact = os.path.join(app.config['artifact-dir'], artifact, artifact)
+    return md5(artifact) or '================================'
 
 
 def md5(filename):
-    # From http://stackoverflow.com/questions/3431825
-    # answer by http://stackoverflow.com/users/370483/quantumsoup
-    hash = hashlib.md5()
+    '''Return the md5 checksum of filename, or None if we can't read it.
+
+    The checksum is usually already recorded next to the file, so this is
+    cheap to call as often as we like.
+
+    '''
     try:
-        with open(filename, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                hash.update(chunk)
-        return hash.hexdigest()
+        return compression.digests(filename)['md5']
     except:
         return None
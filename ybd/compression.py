@@ -0,0 +1,210 @@
+# Copyright (C) 2016  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# =*= License: GPL-2 =*=
+
+'''Compress and decompress artifact tarballs.
+
+The codec for each kind of artifact is set by the compression config. The
+codec used for a tarball is recorded next to it as <key>.codec, and kbas
+sends it as the X-Codec header, so whoever reads the tarball can pick the
+right decoder. Tarballs without a record are recognised by their magic
+bytes.
+
+Tarballs are hashed as they are written or downloaded, and their digests
+are kept next to them too, as <key>.md5 and <key>.sha256, so nothing needs
+to read a tarball again just to checksum it.
+
+'''
+
+import gzip
+import hashlib
+import os
+import tarfile
+import threading
+from subprocess import PIPE, Popen
+
+import app
+import utils
+
+
+CODECS = {
+    # gzip is done in python, so the output matches older artifacts exactly
+    'gzip': {'magic': '\x1f\x8b', 'tar': ['-z']},
+    'zstd': {'magic': '\x28\xb5\x2f\xfd', 'tar': ['--zstd'],
+             'compress': ['zstd', '-q', '-T0', '-c']},
+    'lz4': {'magic': '\x04\x22\x4d\x18', 'tar': ['-I', 'lz4'],
+            'compress': ['lz4', '-q', '-c']},
+    'none': {'tar': []},
+}
+
+DEFAULTS = {'chunk': 'gzip', 'stratum': 'gzip', 'system': 'none'}
+
+DIGESTS = ['md5', 'sha256']
+
+# a fixed timestamp for gzip headers, so the same tree always gives the same
+# tarball
+GZIP_MTIME = 1321009871.0
+
+
+class DigestWriter(object):
+    '''Write to a file, hashing everything on the way.'''
+
+    def __init__(self, f):
+        self._f = f
+        self._offset = 0
+        self._hashes = [(name, hashlib.new(name)) for name in DIGESTS]
+
+    def write(self, data):
+        for name, digest in self._hashes:
+            digest.update(data)
+        self._f.write(data)
+        self._offset += len(data)
+
+    def tell(self):
+        return self._offset
+
+    def flush(self):
+        self._f.flush()
+
+    def digests(self):
+        return dict((name, digest.hexdigest())
+                    for name, digest in self._hashes)
+
+
+def codec_for(dn):
+    '''Return the codec to use for a new artifact of dn's kind.'''
+
+    kind = dn.get('kind', 'chunk')
+    codec = app.config.get('compression', {}).get(kind, DEFAULTS[kind])
+    if codec not in CODECS:
+        app.log(dn, 'ERROR: unknown compression codec', codec, exit=True)
+    return codec
+
+
+def identify(head):
+    '''Return the codec for a tarball which starts with head.'''
+
+    for codec, details in CODECS.items():
+        if details.get('magic') and head.startswith(details['magic']):
+            return codec
+    return 'none'
+
+
+def detect(filename):
+    '''Return the codec used for the tarball at filename.'''
+
+    try:
+        with open(filename + '.codec') as f:
+            codec = f.read().strip()
+        if codec in CODECS:
+            return codec
+    except IOError:
+        pass
+    with open(filename, 'rb') as f:
+        return identify(f.read(4))
+
+
+def record(filename, codec):
+    with open(filename + '.codec', 'w') as f:
+        f.write(codec)
+
+
+def record_digests(filename, digests):
+    for name in DIGESTS:
+        with open(filename + '.' + name, 'w') as f:
+            f.write(digests[name])
+
+
+def digests(filename):
+    '''Return the digests of filename, only hashing it if we have to.'''
+
+    found = {}
+    for name in DIGESTS:
+        try:
+            with open(filename + '.' + name) as f:
+                found[name] = f.read().strip()
+        except IOError:
+            pass
+    if all(found.get(name) for name in DIGESTS):
+        return found
+
+    with open(os.devnull, 'wb') as null:
+        out = DigestWriter(null)
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                out.write(chunk)
+    try:
+        record_digests(filename, out.digests())
+    except IOError:
+        # eg the artifacts are read-only for us
+        pass
+    return out.digests()
+
+
+def _copy(source, out):
+    for chunk in iter(lambda: source.read(65536), b''):
+        out.write(chunk)
+
+
+def tar(codec, mode, filename, *args):
+    '''Return the command to list or extract (mode t or x) a tarball.
+
+    filename can be '-' for stdin.
+
+    '''
+    return ['tar', mode] + CODECS[codec]['tar'] + ['-f', filename] + list(args)
+
+
+def archive(dn, root, filename):
+    '''Write a deterministic tarball of root to filename.
+
+    Systems are archived with directories last, everything else with
+    directories first. The codec and digests are recorded alongside.
+    Returns the codec used.
+
+    '''
+    codec = codec_for(dn)
+    if dn.get('kind') == 'system':
+        add = utils.add_system_to_tarfile
+    else:
+        add = utils.add_directory_to_tarfile
+
+    with open(filename, 'wb') as f:
+        out = DigestWriter(f)
+        if codec == 'gzip':
+            gzip_context = gzip.GzipFile(filename='', mode='wb', fileobj=out,
+                                         mtime=GZIP_MTIME)
+            with gzip_context as f_gzip:
+                with tarfile.TarFile(mode='w', fileobj=f_gzip) as f_tar:
+                    add(f_tar, root)
+        elif codec == 'none':
+            with tarfile.TarFile(mode='w', fileobj=out) as f_tar:
+                add(f_tar, root)
+        else:
+            compressor = Popen(CODECS[codec]['compress'], stdin=PIPE,
+                               stdout=PIPE)
+            reader = threading.Thread(target=_copy,
+                                      args=(compressor.stdout, out))
+            reader.start()
+            with tarfile.open(mode='w|', fileobj=compressor.stdin) as f_tar:
+                add(f_tar, root)
+            compressor.stdin.close()
+            reader.join()
+            if compressor.wait():
+                app.log(dn, 'ERROR: problem compressing', filename, exit=True)
+
+    record(filename, codec)
+    record_digests(filename, out.digests())
+    return codec
@@ -19,7 +19,9 @@ from subprocess import call
 import json
 import app
 import cache
+import compression
 import sandbox
+import utils
 
 
 def deploy(target):
@@ -48,10 +50,16 @@ def deploy_system(system_spec, parent_location=''):
     deploy_defaults = system_spec.get('deploy-defaults')
 
     with sandbox.setup(system):
-        app.log(system, 'Extracting system artifact into', system['sandbox'])
-        with open(cache.get_cache(system), 'r') as artifact:
-            call(['tar', 'x', '--directory', system['sandbox']],
-                 stdin=artifact)
+        unpackdir = cache.get_cache(system) + '.unpacked'
+        if os.path.isdir(unpackdir):
+            app.log(system, 'Copying system artifact into', system['sandbox'])
+            utils.copy_tree(unpackdir, system['sandbox'])
+        else:
+            app.log(system, 'Extracting system artifact into',
+                    system['sandbox'])
+            artifact = cache.get_archive(system)
+            call(compression.tar(compression.detect(artifact), 'x', artifact,
+                                 '--directory', system['sandbox']))
 
         for subsystem in system_spec.get('subsystems', []):
             if deploy_defaults:
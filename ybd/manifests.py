@@ -0,0 +1,149 @@
+# Copyright (C) 2016  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# =*= License: GPL-2 =*=
+
+'''List what each unpacked artifact contains, so staging needn't walk it.
+
+An artifact's manifest is written next to its tarball, as <key>.manifest,
+once its unpacked tree is published (or unpacked from the tarball). It is
+a JSON list of [path, type, mode, size, target, digest] for everything in
+the tree, parents before children, where type is one of 'd', 'f', 'l', 'c'
+or 'b', target is a symlink's target or a device's number, and digest is
+the file's name in the object store.
+
+This is nothing to do with the manifest of a whole build, which is written
+if the 'manifest' option is set.
+
+'''
+
+import json
+import os
+import stat
+import tempfile
+
+import app
+import objects
+
+
+TYPES = [(stat.S_ISDIR, 'd'), (stat.S_ISREG, 'f'), (stat.S_ISLNK, 'l'),
+         (stat.S_ISCHR, 'c'), (stat.S_ISBLK, 'b')]
+
+
+def _path(unpackdir):
+    return unpackdir[:-len('.unpacked')] + '.manifest'
+
+
+def write(unpackdir):
+    '''Write the manifest for unpackdir, returning a dict of path -> digest.
+
+    Digests are only worked out if the object store is in use, for
+    objects.add(). If the tree has anything staging can't handle there is
+    no manifest, so staging walks the tree and complains as usual.
+
+    '''
+    digests = {}
+    entries = []
+    for dirname, subdirs, filenames in os.walk(unpackdir):
+        for name in sorted(subdirs + filenames):
+            path = os.path.join(dirname, name)
+            relpath = os.path.relpath(path, unpackdir)
+            st = os.lstat(path)
+            kinds = [kind for test, kind in TYPES if test(st.st_mode)]
+            if not kinds:
+                return digests
+            target = None
+            if kinds[0] == 'l':
+                target = os.readlink(path)
+            elif kinds[0] in 'cb':
+                target = st.st_rdev
+            elif kinds[0] == 'f' and app.config.get('object-store', True):
+                digests[relpath] = objects.digest_of(path, st)
+            entries.append([relpath, kinds[0], stat.S_IMODE(st.st_mode),
+                            st.st_size, target, digests.get(relpath)])
+
+    fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(unpackdir))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(entries, f, separators=(',', ':'))
+        os.rename(tmpfile, _path(unpackdir))
+    except (UnicodeDecodeError, OSError):
+        # eg filenames which aren't UTF-8; staging can still walk the tree
+        app.log(unpackdir, 'WARNING: unable to write manifest', verbose=True)
+        os.remove(tmpfile)
+    return digests
+
+
+def load(unpackdir):
+    '''Return the manifest for unpackdir, or None if it doesn't have one.'''
+
+    if not unpackdir.endswith('.unpacked'):
+        return None
+    try:
+        with open(_path(unpackdir)) as f:
+            entries = json.load(f)
+    except (IOError, ValueError):
+        return None
+    for entry in entries:
+        entry[0] = entry[0].encode('utf-8')
+        if entry[1] == 'l':
+            entry[4] = entry[4].encode('utf-8')
+    return entries
+
+
+def overlaps(found):
+    '''Return the paths at which staging layers in order would overlap.
+
+    found is the layers' manifests, in order. As in utils.hardlink_all_files(),
+    that is where a symlink in one layer replaces anything from an earlier
+    one. Layers without manifests are skipped.
+
+    '''
+    paths = []
+    seen = set()
+    for entries in found:
+        if entries is None:
+            continue
+        paths += ['/' + entry[0] for entry in entries
+                  if entry[1] == 'l' and entry[0] in seen]
+        seen.update(entry[0] for entry in entries)
+    return paths
+
+
+def conflicts(found, start=0):
+    '''Return the paths at which an overlay of layers would differ from
+    hardlinking them in order, as utils.hardlink_all_files() does.
+
+    found is the layers' manifests, in order. Hardlinking merges a directory
+    into the target of an earlier symlink, and fails for a directory over
+    anything else, or for anything but a symlink over a directory, where an
+    overlay just hides whatever is below. Only conflicts made by the layers
+    from start on are returned, since the earlier ones are already staged in
+    a snapshot. A layer without a manifest can't be checked, so counts as a
+    conflict at '/'.
+
+    '''
+    paths = []
+    kinds = {}
+    for number, entries in enumerate(found):
+        if entries is None:
+            return ['/']
+        for entry in entries:
+            below = kinds.get(entry[0])
+            if number >= start and below and below != entry[1]:
+                if 'd' in (below, entry[1]) and entry[1] != 'l':
+                    paths.append('/' + entry[0])
+            if entry[1] != 'd' or below is None:
+                kinds[entry[0]] = entry[1]
+    return paths
@@ -0,0 +1,171 @@
+# Copyright (C) 2016  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# =*= License: GPL-2 =*=
+
+'''Share identical files between unpacked artifacts.
+
+Each new cache-key of a component usually differs from the last one in only
+a few files, so the files of unpacked artifacts are hardlinked into a store
+in artifacts/.objects, keyed by a digest of their contents, mode, owner and
+mtime. Identical files in any number of artifacts are then one inode.
+
+The link count of a file in the store is its reference count: once it drops
+to 1, no artifact uses the file any more and it can be removed.
+
+Tarballs are made from unpacked artifacts, and tar records files which are
+hardlinked to each other. So that sharing never changes a tarball, files
+which are already hardlinks are left alone, and no two files in the same
+artifact are linked to the same file in the store.
+
+'''
+
+import errno
+import hashlib
+import os
+import stat
+
+import app
+
+
+def _store():
+    return os.path.join(app.config['artifacts'], '.objects')
+
+
+def digest_of(path, st):
+    digest = hashlib.sha256('%o %d %d %d\0' % (st.st_mode, st.st_uid,
+                                               st.st_gid, int(st.st_mtime)))
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def add(root, digests=None):
+    '''Replace the files in root with links to identical files in the store.
+
+    digests can give the digest of files by their path in root, if they
+    are already known. Returns the number of bytes saved.
+
+    '''
+    if not app.config.get('object-store', True):
+        return 0
+    digests = digests or {}
+    saved = 0
+    seen = set()
+    for dirname, subdirs, filenames in os.walk(root):
+        # replacing files changes the directory's mtime, which tar records
+        dirstat = os.lstat(dirname)
+        changed = False
+        for filename in filenames:
+            path = os.path.join(dirname, filename)
+            st = os.lstat(path)
+            if not stat.S_ISREG(st.st_mode) or st.st_size == 0 or \
+                    st.st_nlink > 1:
+                continue
+            digest = digests.get(os.path.relpath(path, root)) or \
+                digest_of(path, st)
+            if digest in seen:
+                continue
+            seen.add(digest)
+            obj = os.path.join(_store(), digest[:2], digest)
+            try:
+                if not os.path.isdir(os.path.dirname(obj)):
+                    os.makedirs(os.path.dirname(obj))
+            except OSError:
+                # another instance made it
+                pass
+            try:
+                os.link(path, obj)
+                continue
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    continue
+            if os.lstat(obj).st_ino == st.st_ino:
+                continue
+            tmp = os.path.join(dirname, '.%s.ybd-object' % filename)
+            changed = True
+            try:
+                os.link(obj, tmp)
+                os.rename(tmp, path)
+                saved += st.st_size
+            except OSError:
+                # eg too many links to obj, so leave this file alone
+                if os.path.lexists(tmp):
+                    os.remove(tmp)
+        if changed:
+            os.utime(dirname, (dirstat.st_atime, dirstat.st_mtime))
+    return saved
+
+
+def index():
+    '''Return a dict of inode -> path for every file in the store.'''
+
+    found = {}
+    for dirname, subdirs, filenames in os.walk(_store()):
+        for filename in filenames:
+            path = os.path.join(dirname, filename)
+            found[os.lstat(path).st_ino] = path
+    return found
+
+
+def shared(root):
+    '''Return the inodes of files in root which only root and the store use.
+
+    These are the files whose space is freed when root is removed.
+
+    '''
+    inodes = set()
+    for dirname, subdirs, filenames in os.walk(root):
+        for filename in filenames:
+            st = os.lstat(os.path.join(dirname, filename))
+            if stat.S_ISREG(st.st_mode) and st.st_nlink == 2:
+                inodes.add(st.st_ino)
+    return inodes
+
+
+def release(inodes, objects):
+    '''Remove the files for inodes from the store, if nothing else uses them.
+
+    objects is the result of index(). Returns the number of bytes freed.
+
+    '''
+    freed = 0
+    for inode in inodes:
+        path = objects.get(inode)
+        if path is None:
+            continue
+        try:
+            st = os.lstat(path)
+            if st.st_ino == inode and st.st_nlink == 1:
+                os.remove(path)
+                freed += st.st_size
+        except OSError:
+            pass
+        objects.pop(inode, None)
+    return freed
+
+
+def collect():
+    '''Remove every file from the store which no artifact uses.'''
+
+    freed = 0
+    for dirname, subdirs, filenames in os.walk(_store()):
+        for filename in filenames:
+            path = os.path.join(dirname, filename)
+            st = os.lstat(path)
+            if st.st_nlink == 1:
+                os.remove(path)
+                freed += st.st_size
+    return freed
@@ -15,6 +15,7 @@
 # =*= License: GPL-2 =*=
 
 import os
+import sqlite3
 import yaml
 from app import config, log
 from defaults import Defaults
@@ -66,34 +67,121 @@ class Pots(object):
         return yaml.safe_load(text)
 
     def _set_trees(self):
-        '''Use the tree values from .trees file, to save time'''
+        '''Use the tree values from the trees database, to save time'''
         try:
-            with open(os.path.join(config['artifacts'], '.trees')) as f:
-                text = f.read()
-                self._trees = yaml.safe_load(text)
+            self._trees = Trees(dict((path, dn.get('repo'))
+                                     for path, dn in self._data.items()))
+            wanted = set((dn['repo'], dn['ref']) for dn in self._data.values()
+                         if dn.get('repo') and dn.get('ref'))
+            trees = self._trees.get(sorted(wanted))
             count = 0
-            for path in self._data:
-                dn = self._data[path]
-                if dn.get('ref') and self._trees.get(path):
-                    if dn['ref'] == self._trees.get(path)[0]:
-                        dn['tree'] = self._trees.get(path)[1]
-                        count += 1
-            log('DEFINITIONS', 'Re-used %s entries from .trees file' % count)
+            for dn in self._data.values():
+                tree = trees.get((dn.get('repo'), dn.get('ref')))
+                if tree:
+                    dn['tree'] = tree
+                    count += 1
+            log('DEFINITIONS', 'Re-used %s entries from trees database' %
+                count)
         except:
-            log('DEFINITIONS', 'WARNING: problem with .trees file')
-            pass
+            log('DEFINITIONS', 'WARNING: problem with trees database')
+            self._trees = None
 
     def save_trees(self):
-        '''Creates the .trees file for the current working directory
+        '''Record git trees for the refs of all definitions
 
-        .trees contains lookups of git trees from git refs for all definitions
+        The trees database contains lookups of git trees from git refs
         '''
-        for name in self._data:
-            if self._data[name].get('tree') is not None:
-                if len(self._data[name]['ref']) == 40:
+        if self._trees is None:
+            return
+        entries = {}
+        for dn in self._data.values():
+            if dn.get('tree') is not None and dn.get('repo'):
+                if len(dn['ref']) == 40:
                     # only save tree entry for full SHA
-                    self._trees[name] = [self._data[name]['ref'],
-                                         self._data[name]['tree'],
-                                         self._data[name].get('cache')]
-        with open(os.path.join(config['artifacts'], '.trees'), 'w') as f:
-            f.write(yaml.safe_dump(self._trees, default_flow_style=False))
+                    entries[(dn['repo'], dn['ref'])] = dn['tree']
+        try:
+            self._trees.put(entries)
+        except:
+            log('DEFINITIONS', 'WARNING: unable to save trees database')
+        # don't carry an open database into forked workers
+        self._trees.close()
+        self._trees = None
+
+
+class Trees(object):
+    '''An sqlite database of (repo, ref) -> tree, in artifacts.
+
+    Several instances of ybd can share one artifacts directory, so entries
+    are inserted in place rather than rewriting the whole table, and lookups
+    only read the rows we ask for. Entries from an old .trees file, which
+    was keyed by definition path, are imported the first time the database
+    is created, using repos to map each path to its repo.
+
+    '''
+
+    def __init__(self, repos):
+        self._file = os.path.join(config['artifacts'], '.trees.db')
+        self._db = sqlite3.connect(self._file, timeout=60)
+        self._db.text_factory = str
+        try:
+            self._db.execute('PRAGMA journal_mode=WAL')
+        except sqlite3.Error:
+            # eg artifacts on a network filesystem; default locking is fine
+            pass
+        with self._db:
+            columns = [row[1] for row in
+                       self._db.execute('PRAGMA table_info(trees)')]
+            if 'path' in columns:
+                # keyed by definition path; it's only a cache, so start again
+                self._db.execute('DROP TABLE trees')
+            self._db.execute('CREATE TABLE IF NOT EXISTS trees ('
+                             'repo TEXT, ref TEXT, tree TEXT, '
+                             'PRIMARY KEY (repo, ref))')
+        self._known = {}
+        self._migrate(repos)
+
+    def _migrate(self, repos):
+        old = os.path.join(config['artifacts'], '.trees')
+        if not os.path.isfile(old):
+            return
+        with open(old) as f:
+            entries = yaml.safe_load(f.read()) or {}
+        self.put(dict(((repos[path], entry[0]), entry[1])
+                      for path, entry in entries.items()
+                      if repos.get(path) and len(entry) > 1))
+        os.remove(old)
+        log('DEFINITIONS', 'Imported %s entries from .trees file' %
+            len(entries))
+
+    def get(self, keys, batch=250):
+        '''Return {(repo, ref): tree} for the (repo, ref) keys we know.'''
+
+        found = {}
+        for i in range(0, len(keys), batch):
+            chunk = keys[i:i + batch]
+            rows = self._db.execute(
+                'SELECT repo, ref, tree FROM trees WHERE %s' %
+                ' OR '.join(['(repo = ? AND ref = ?)'] * len(chunk)),
+                [value for key in chunk for value in key])
+            for repo, ref, tree in rows:
+                found[(repo, ref)] = tree
+        self._known.update(found)
+        return found
+
+    def put(self, entries):
+        '''Insert or update entries, skipping any which are unchanged.'''
+
+        changed = [(repo, ref, tree)
+                   for (repo, ref), tree in entries.items()
+                   if self._known.get((repo, ref)) != tree]
+        if not changed:
+            return
+        with self._db:
+            self._db.executemany('INSERT OR REPLACE INTO trees '
+                                 '(repo, ref, tree) VALUES (?, ?, ?)',
+                                 changed)
+        for repo, ref, tree in changed:
+            self._known[(repo, ref)] = tree
+
+    def close(self):
+        self._db.close()
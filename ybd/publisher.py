@@ -0,0 +1,184 @@
+# Copyright (C) 2016  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# =*= License: GPL-2 =*=
+
+'''Publish artifacts, keeping archiving and uploading off the critical path.
+
+Later builds only need the unpacked tree of an artifact, so a finished
+install tree is moved straight into the artifacts directory as
+<key>/<key>.unpacked. Writing the tarball and checksumming it are then done
+by background processes, which hand the artifact on to the uploader.
+
+With lazy-archives, only artifacts which will be uploaded are archived
+straight away. Anything else gets its tarball when something asks for it,
+via cache.get_archive().
+
+Each artifact waiting for its tarball has a marker in artifacts/.pending,
+which is only removed once the tarball is in place. If ybd stops before
+then, the next run queues the artifact again.
+
+'''
+
+import errno
+import os
+import re
+import shutil
+import tempfile
+from multiprocessing import Process, Queue
+from Queue import Empty
+
+import app
+import cache
+import compression
+import manifests
+import objects
+import uploader
+import utils
+
+
+_queue = None
+_workers = []
+
+
+def _pending(key=''):
+    return os.path.join(app.config['artifacts'], '.pending', key)
+
+
+def start():
+    '''Fork the publishers, and queue anything left over from last time.'''
+
+    global _queue
+    _queue = Queue(app.config.get('publish-queue', 4))
+    for i in range(app.config.get('publishers', 1)):
+        worker = Process(target=_work)
+        worker.start()
+        _workers.append(worker)
+
+    if os.path.isdir(_pending()):
+        for key in sorted(os.listdir(_pending())):
+            with open(_pending(key)) as f:
+                kind = f.read()
+            app.log(key, 'Queueing unfinished artifact')
+            _queue.put((key, kind, True))
+
+
+def publish(dn):
+    '''Move dn's install tree into the artifacts directory, then queue it.'''
+
+    utils.set_mtime_recursively(dn['install'])
+    eager = uploader.wanted(dn) or not app.config.get('lazy-archives', True)
+    if eager:
+        if not os.path.isdir(_pending()):
+            os.makedirs(_pending())
+        with open(_pending(dn['cache']), 'w') as f:
+            f.write(dn.get('kind', 'chunk'))
+
+    tempfile.tempdir = app.config['tmp']
+    tmpdir = tempfile.mkdtemp()
+    unpackdir = os.path.join(tmpdir, dn['cache'] + '.unpacked')
+    shutil.move(dn['install'], unpackdir)
+    # done before publishing, since once it's published another build may
+    # be using the tree as an overlay layer, which mustn't change
+    objects.add(unpackdir, manifests.write(unpackdir))
+    path = os.path.join(app.config['artifacts'], dn['cache'])
+    try:
+        os.rename(tmpdir, path)
+    except OSError as e:
+        if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+            raise
+        # another instance got there first, and will finish the job
+        app.log(dn, 'Bah! I raced on', dn['cache'])
+        shutil.rmtree(tmpdir)
+        return
+    cache.artifacts.published(dn['cache'])
+
+    app.log(dn, 'Published unpacked artifact', dn['cache'])
+    if _queue is None:
+        _process(dn['cache'], dn.get('kind', 'chunk'), eager)
+    else:
+        _queue.put((dn['cache'], dn.get('kind', 'chunk'), eager))
+
+
+def _work():
+    parent = os.getppid()
+    while True:
+        try:
+            item = _queue.get(timeout=1)
+        except Empty:
+            if os.getppid() != parent:
+                # ybd exited without stopping us, eg after an error
+                break
+            continue
+        if item is None:
+            break
+        _process(*item)
+
+
+def _process(key, kind, eager):
+    if eager:
+        archive(key, kind)
+    path = os.path.join(app.config['artifacts'], key)
+    cache.record_access(key, utils.tree_size(path))
+
+
+def archive(key, kind):
+    '''Create the tarball for an unpacked artifact, and queue its upload.'''
+
+    dn = {'name': key.rsplit('.', 1)[0], 'cache': key, 'kind': kind}
+    cachefile = os.path.join(app.config['artifacts'], key, key)
+    if not os.path.exists(cachefile):
+        unpackdir = cachefile + '.unpacked'
+        if not os.path.isdir(unpackdir):
+            app.log(dn, 'WARNING: nothing to archive at', unpackdir)
+            _finish(key)
+            return
+        tempfile.tempdir = app.config['tmp']
+        tmpfile = os.path.join(tempfile.mkdtemp(), key)
+        compression.archive(dn, unpackdir, tmpfile)
+        for sidecar in ['.codec'] + ['.' + d for d in compression.DIGESTS]:
+            shutil.move(tmpfile + sidecar, cachefile + sidecar)
+        shutil.move(tmpfile, cachefile)
+        shutil.rmtree(os.path.dirname(tmpfile))
+
+    checksum = cache.md5(cachefile)
+    size = os.path.getsize(cachefile)
+    size = re.sub("(\d)(?=(\d{3})+(?!\d))", r"\1,", "%d" % size)
+    app.log(dn, 'Cached %s bytes %s as' % (size, checksum), key)
+    uploader.queue(dn)
+    _finish(key)
+
+
+def _finish(key):
+    try:
+        os.remove(_pending(key))
+    except OSError:
+        # another instance has finished the same artifact
+        pass
+
+
+def stop(abort=False):
+    '''Wait for the publishers to finish everything in the queue.'''
+
+    if abort:
+        for worker in _workers:
+            worker.terminate()
+    else:
+        if _workers:
+            app.log('PUBLISHER', 'Waiting for artifacts to be archived')
+        for worker in _workers:
+            _queue.put(None)
+    for worker in _workers:
+        worker.join()
+    del _workers[:]
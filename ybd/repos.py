@@ -14,13 +14,18 @@
 #
 # =*= License: GPL-2 =*=
 
+import collections
 import contextlib
+import fcntl
 import os
 import re
 import shutil
 import string
-from subprocess import call, check_output
+from multiprocessing.pool import ThreadPool
+from subprocess import call, check_output, PIPE, Popen
 import sys
+from threading import Condition, Lock, Thread
+import time
 import requests
 import app
 import utils
@@ -31,8 +36,10 @@ if sys.version_info.major == 2:
     # For compatibility with Python 2.
     from ConfigParser import RawConfigParser
     from StringIO import StringIO
+    from urlparse import urlparse
 else:
     from configparser import RawConfigParser
+    from urllib.parse import urlparse
     from io import StringIO
 
 
@@ -62,15 +69,24 @@ def get_repo_name(repo):
 
 
 def get_version(gitdir, ref='HEAD'):
+    '''Describe the checkout in gitdir, where ref is checked out.
+
+    git describe --long gives us the tag and the number of commits since,
+    so one git process is enough.
+
+    '''
     try:
-        with app.chdir(gitdir), open(os.devnull, "w") as fnull:
-            version = check_output(['git', 'describe', '--tags', '--dirty'],
-                                   stderr=fnull)[0:-1]
-            tag = check_output(['git', 'describe', '--abbrev=0',
-                                '--tags', ref], stderr=fnull)[0:-1]
-            commits = check_output(['git', 'rev-list', tag + '..' + ref,
-                                    '--count'])[0:-1]
-        result = "%s %s (%s + %s commits)" % (ref[:8], version, tag, commits)
+        with open(os.devnull, "w") as fnull:
+            described = check_output(['git', 'describe', '--tags', '--long',
+                                      '--dirty'], stderr=fnull,
+                                     cwd=gitdir)[0:-1]
+        dirty = ''
+        if described.endswith('-dirty'):
+            described, dirty = described[:-6], '-dirty'
+        tag, commits, sha = described.rsplit('-', 2)
+        version = tag if commits == '0' else described
+        result = "%s %s%s (%s + %s commits)" % (ref[:8], version, dirty, tag,
+                                                commits)
     except:
         result = ref[:8] + " (No tag found)"
 
@@ -87,41 +103,383 @@ def get_last_tag(gitdir):
         return None
 
 
+def get_gitdir(repo):
+    if repo.startswith('file://') or repo.startswith('/'):
+        return repo.replace('file://', '')
+    return os.path.join(app.config['gits'], get_repo_name(repo))
+
+
+class GitObjects(object):
+    '''Answer questions about the objects in a git repo.
+
+    One long-running `git cat-file --batch` process serves all the queries
+    for a repo, instead of a new git process for each, and answers are kept
+    in a small LRU cache. Use objects(gitdir) to get the one for a repo.
+
+    Only max_processes of the git processes are kept running, the least
+    recently started being stopped first; a stopped one starts again when
+    it is next needed.
+
+    '''
+
+    cache_size = 1024
+    max_processes = 16
+
+    def __init__(self, gitdir):
+        self.gitdir = gitdir
+        self._lock = Lock()
+        self._cache = collections.OrderedDict()
+        self._git = None
+
+    def _read(self, obj):
+        '''Return (sha, type, content) for obj, or None if it's missing.'''
+
+        with self._lock:
+            if obj in self._cache:
+                self._cache[obj] = self._cache.pop(obj)
+                return self._cache[obj]
+            if self._git is None:
+                # git outlives the call that starts it, so it mustn't
+                # inherit other threads' pipes and repo locks
+                with open(os.devnull, "w") as fnull:
+                    self._git = Popen(['git', 'cat-file', '--batch'],
+                                      cwd=self.gitdir, stdin=PIPE,
+                                      stdout=PIPE, stderr=fnull,
+                                      close_fds=True)
+                _started(self)
+            self._git.stdin.write(obj + '\n')
+            self._git.stdin.flush()
+            # header is '<sha> <type> <size>', or '<obj> missing|ambiguous'
+            fields = self._git.stdout.readline().split()
+            result = None
+            if len(fields) == 3:
+                content = self._git.stdout.read(int(fields[2]) + 1)[:-1]
+                result = (fields[0], fields[1], content)
+            elif len(fields) != 2:
+                self._close()
+                raise Exception('unexpected reply from git cat-file')
+            if result is not None:
+                # missing objects may be fetched later, so aren't cached
+                self._cache[obj] = result
+                if len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+            return result
+
+    def type(self, ref):
+        found = self._read(ref)
+        return found[1] if found else None
+
+    def tree(self, ref):
+        '''Return the sha of the tree for ref, or None.'''
+
+        found = self._read(ref + '^{tree}')
+        return found[0] if found else None
+
+    def commit_time(self, ref):
+        '''Return the committer timestamp of ref, like %ct, or None.'''
+
+        found = self._read(ref + '^{commit}')
+        if found is None:
+            return None
+        for line in found[2].splitlines():
+            if line.startswith('committer '):
+                return line.split()[-2]
+            if not line:
+                break
+        return None
+
+    def ls_tree(self, ref, path):
+        '''Return (mode, type, sha) for path in ref, or None.'''
+
+        found = self._read(ref + '^{tree}')
+        entry = None
+        for name in path.strip('/').split('/'):
+            if not found or found[1] != 'tree':
+                return None
+            entry = self._tree_entry(found[2], name)
+            if entry is None:
+                return None
+            found = self._read(entry[2]) if entry[1] == 'tree' else None
+        return entry
+
+    def _tree_entry(self, content, name):
+        # entries are '<mode> <name>\0<20-byte sha>'
+        i = 0
+        while i < len(content):
+            space = content.index(' ', i)
+            null = content.index('\0', space)
+            sha = content[null + 1:null + 21].encode('hex')
+            if content[space + 1:null] == name:
+                mode = content[i:space]
+                if mode == '160000':
+                    kind = 'commit'
+                elif mode.startswith('4'):
+                    kind = 'tree'
+                else:
+                    kind = 'blob'
+                return (mode.rjust(6, '0'), kind, sha)
+            i = null + 21
+        return None
+
+    def _close(self):
+        with _objects_lock:
+            if _running.get(self.gitdir) is self:
+                del _running[self.gitdir]
+        if self._git is not None:
+            # forked workers may hold our end of the pipe open, so we can't
+            # rely on git seeing the end of its input
+            try:
+                self._git.kill()
+                self._git.wait()
+            except:
+                pass
+            self._git = None
+
+
+_objects = {}
+_objects_lock = Lock()
+_objects_pid = None
+_running = collections.OrderedDict()
+
+
+def _started(started):
+    '''Note that started has a git process, stopping the oldest if need be.'''
+
+    with _objects_lock:
+        _running.pop(started.gitdir, None)
+        _running[started.gitdir] = started
+        excess = len(_running) - GitObjects.max_processes
+        oldest = [running for running in _running.values()
+                  if running is not started]
+    for running in oldest:
+        if excess <= 0:
+            break
+        # a process which is busy can wait until next time; waiting for it
+        # could deadlock with a thread which is starting one
+        if running._lock.acquire(False):
+            try:
+                running._close()
+            finally:
+                running._lock.release()
+            excess -= 1
+
+
+def close_objects():
+    '''Stop all the git processes, eg before forking workers.'''
+
+    with _objects_lock:
+        running = _running.values()
+    for gitobjects in running:
+        with gitobjects._lock:
+            gitobjects._close()
+
+
+def objects(gitdir):
+    '''Return the GitObjects for gitdir.
+
+    A forked process must not share the cat-file processes of its parent, so
+    each process starts with its own.
+
+    '''
+    global _objects_pid
+    with _objects_lock:
+        if _objects_pid != os.getpid():
+            _objects.clear()
+            _running.clear()
+            _objects_pid = os.getpid()
+        if gitdir not in _objects:
+            _objects[gitdir] = GitObjects(gitdir)
+        return _objects[gitdir]
+
+
+def forget_objects(gitdir):
+    '''Drop what we know about gitdir, eg because it has been fetched.'''
+
+    with _objects_lock:
+        if _objects_pid != os.getpid() or gitdir not in _objects:
+            return
+        gitobjects = _objects.pop(gitdir)
+    with gitobjects._lock:
+        gitobjects._close()
+
+
 def get_tree(dn):
-    ref = str(dn['ref'])
-    gitdir = os.path.join(app.config['gits'], get_repo_name(dn['repo']))
+    resolve_trees([dn])
+    return dn['tree']
+
+
+def resolve_trees(components):
+    '''Set the git tree for every component which has a repo but no tree.
+
+    Components are grouped by repo, so each repo's refs can be resolved by a
+    single git process. Repos are handled in parallel, since many will need
+    to be mirrored or updated over the network.
+
+    '''
+    repos = {}
+    for dn in components:
+        if dn.get('repo') and not dn.get('tree'):
+            repos.setdefault(get_gitdir(dn['repo']), []).append(dn)
+    if not repos:
+        return
+
+    pool = ThreadPool(min(len(repos), app.config.get('git-jobs', 8)))
+    try:
+        pool.map(_resolve_repo_trees, repos.values())
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _resolve_repo_trees(components):
+    dn = components[0]
+    gitdir = get_gitdir(dn['repo'])
     if dn['repo'].startswith('file://') or dn['repo'].startswith('/'):
-        gitdir = dn['repo'].replace('file://', '')
         if not os.path.isdir(gitdir):
             app.log(dn, 'Git repo not found:', dn['repo'], exit=True)
 
     if not os.path.exists(gitdir):
-        try:
-            params = {'repo': get_repo_url(dn['repo']), 'ref': ref}
-            r = requests.get(url=app.config['tree-server'], params=params)
-            return r.json()['tree']
-        except:
-            if app.config.get('tree-server'):
-                app.log(dn, 'WARNING: no tree from tree-server for', ref)
+        for dn in components:
+            dn['tree'] = _tree_from_server(dn)
+        components = [dn for dn in components if not dn['tree']]
+        if not components:
+            return
+        with mirror_lock(gitdir):
+            if not os.path.exists(gitdir):
+                mirror(dn['name'], dn['repo'])
+
+    refs = sorted(set(str(dn['ref']) for dn in components))
+    trees = _batch_trees(gitdir, refs)
+    if len(trees) < len(refs):
+        # can't resolve some refs. are they upstream?
+        app.log(dn, 'Fetching from upstream to resolve',
+                sorted(set(refs) - set(trees)))
+        with mirror_lock(gitdir):
+            update_mirror(dn['name'], dn['repo'], gitdir)
+        trees = _batch_trees(gitdir, refs)
 
-        mirror(dn['name'], dn['repo'])
+    for dn in components:
+        dn['tree'] = trees.get(str(dn['ref']))
+        if dn['tree'] is None:
+            # either ref is not unique or ref does not exist
+            app.log(dn, 'No tree for ref', (dn['ref'], gitdir), exit=True)
 
-    with app.chdir(gitdir), open(os.devnull, "w") as fnull:
-        if call(['git', 'rev-parse', ref + '^{object}'], stdout=fnull,
-                stderr=fnull):
-            # can't resolve ref. is it upstream?
-            app.log(dn, 'Fetching from upstream to resolve %s' % ref)
-            update_mirror(dn['name'], dn['repo'], gitdir)
 
+def _tree_from_server(dn):
+    try:
+        params = {'repo': get_repo_url(dn['repo']), 'ref': str(dn['ref'])}
+        r = requests.get(url=app.config['tree-server'], params=params)
+        return r.json()['tree']
+    except:
+        if app.config.get('tree-server'):
+            app.log(dn, 'WARNING: no tree from tree-server for', dn['ref'])
+    return None
+
+
+def _batch_trees(gitdir, refs):
+    '''Return a dict of the trees for whichever refs exist in gitdir.'''
+
+    trees = {}
+    for ref in refs:
+        tree = objects(gitdir).tree(ref)
+        if tree is not None:
+            trees[ref] = tree
+    return trees
+
+
+def prefetch(components):
+    '''Make sure mirrors are up to date for the chunks we need to build.
+
+    Mirrors are fetched in background threads, in the order given, so the
+    first builds can start while the rest of the sources are downloading. A
+    build which needs a repo that is still being fetched will wait for it,
+    via mirror_lock().
+
+    No more than git-jobs fetches run at once, and no more than
+    git-jobs-per-host against any one host.
+
+    '''
+    wanted = {}
+    queue = []
+    for dn in components:
+        if dn.get('kind', 'chunk') != 'chunk' or not dn.get('repo'):
+            continue
+        repo_url = get_repo_url(dn['repo'])
+        if repo_url not in wanted:
+            wanted[repo_url] = (dn['name'], dn['repo'], [])
+            host = urlparse(repo_url).netloc or 'localhost'
+            queue.append((host, wanted[repo_url]))
+        if str(dn['ref']) not in wanted[repo_url][2]:
+            wanted[repo_url][2].append(str(dn['ref']))
+
+    if not wanted:
+        return
+
+    running = dict((host, 0) for host, item in queue)
+    app.log('PREFETCH', 'Fetching sources for %s repos from' % len(wanted),
+            '%s hosts' % len(running))
+    limit = app.config.get('git-jobs-per-host', 2)
+    jobs = min(len(queue), app.config.get('git-jobs', 8),
+               limit * len(running))
+    ready = Condition()
+    for i in range(jobs):
+        thread = Thread(target=_prefetch, args=(queue, running, limit, ready))
+        thread.daemon = True
+        thread.start()
+
+
+def _prefetch(queue, running, limit, ready):
+    while True:
+        with ready:
+            while True:
+                if not queue:
+                    return
+                item = next((item for item in queue
+                             if running[item[0]] < limit), None)
+                if item is not None:
+                    break
+                # every host with work left is busy
+                ready.wait()
+            queue.remove(item)
+            host, (name, repo, refs) = item
+            running[host] += 1
         try:
-            tree = check_output(['git', 'rev-parse', ref + '^{tree}'],
-                                universal_newlines=True)[0:-1]
-            return tree
+            _prefetch_repo(name, repo, refs)
+        finally:
+            with ready:
+                running[host] -= 1
+                ready.notify_all()
 
-        except:
-            # either we don't have a git dir, or ref is not unique
-            # or ref does not exist
-            app.log(dn, 'No tree for ref', (ref, gitdir), exit=True)
+
+def _prefetch_repo(name, repo, refs):
+    gitdir = os.path.join(app.config['gits'], get_repo_name(repo))
+    with mirror_lock(gitdir):
+        starttime = time.time()
+        if not os.path.exists(gitdir):
+            size = 0
+            mirror(name, repo)
+        elif len(_batch_trees(gitdir, refs)) < len(refs):
+            size = utils.tree_size(gitdir)
+            update_mirror(name, repo, gitdir)
+        else:
+            return
+        size = utils.tree_size(gitdir) - size
+        app.log(name, 'Prefetched %s bytes in %.1f seconds from' %
+                (size, time.time() - starttime), repo)
+
+
+@contextlib.contextmanager
+def mirror_lock(gitdir):
+    '''Serialise creating and updating a mirror, across ybd instances.'''
+
+    if not os.path.isdir(app.config['gits']):
+        os.makedirs(app.config['gits'])
+    with open(gitdir + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
 
 
 def mirror(name, repo):
@@ -132,12 +490,13 @@ def mirror(name, repo):
         app.log(name, 'Try fetching tarball %s' % tar_file)
         tmpdir = tempfile.mkdtemp()
         # try tarball first
-        with app.chdir(tmpdir), open(os.devnull, "w") as fnull:
+        with open(os.devnull, "w") as fnull:
             call(['wget', os.path.join(app.config['tar-url'], tar_file)],
-                 stdout=fnull, stderr=fnull)
-            call(['tar', 'xf', tar_file], stderr=fnull)
-            call(['git', 'config', 'gc.autodetach', 'false'], stderr=fnull)
-            os.remove(tar_file)
+                 stdout=fnull, stderr=fnull, cwd=tmpdir)
+            call(['tar', 'xf', tar_file], stderr=fnull, cwd=tmpdir)
+            call(['git', 'config', 'gc.autodetach', 'false'], stderr=fnull,
+                 cwd=tmpdir)
+            os.remove(os.path.join(tmpdir, tar_file))
             update_mirror(name, repo, tmpdir)
     except:
         app.log(name, 'Try git clone from', repo_url)
@@ -146,9 +505,8 @@ def mirror(name, repo):
             if call(['git', 'clone', '--mirror', '-n', repo_url, tmpdir]):
                 app.log(name, 'Failed to clone', repo, exit=True)
 
-    with app.chdir(tmpdir):
-        if call(['git', 'rev-parse']):
-            app.log(name, 'Problem mirroring git repo at', tmpdir, exit=True)
+    if call(['git', 'rev-parse'], cwd=tmpdir):
+        app.log(name, 'Problem mirroring git repo at', tmpdir, exit=True)
 
     gitdir = os.path.join(app.config['gits'], get_repo_name(repo))
     try:
@@ -164,18 +522,17 @@ def fetch(repo):
 
 
 def mirror_has_ref(gitdir, ref):
-    with app.chdir(gitdir), open(os.devnull, "w") as fnull:
-        out = call(['git', 'cat-file', '-t', ref], stdout=fnull, stderr=fnull)
-        return out == 0
+    return objects(gitdir).type(ref) is not None
 
 
 def update_mirror(name, repo, gitdir):
-    with app.chdir(gitdir), open(os.devnull, "w") as fnull:
+    with open(os.devnull, "w") as fnull:
         app.log(name, 'Refreshing mirror for %s' % repo)
         repo_url = get_repo_url(repo)
         if call(['git', 'fetch', repo_url, '+refs/*:refs/*', '--prune'],
-                stdout=fnull, stderr=fnull):
+                stdout=fnull, stderr=fnull, cwd=gitdir):
             app.log(name, 'Git update mirror failed', repo, exit=True)
+    forget_objects(gitdir)
 
 
 def checkout(dn):
@@ -190,10 +547,11 @@ def checkout(dn):
 
 def _checkout(name, repo, ref, checkout):
     gitdir = os.path.join(app.config['gits'], get_repo_name(repo))
-    if not os.path.exists(gitdir):
-        mirror(name, repo)
-    elif not mirror_has_ref(gitdir, ref):
-        update_mirror(name, repo, gitdir)
+    with mirror_lock(gitdir):
+        if not os.path.exists(gitdir):
+            mirror(name, repo)
+        elif not mirror_has_ref(gitdir, ref):
+            update_mirror(name, repo, gitdir)
     # checkout the required version from git
     with open(os.devnull, "w") as fnull:
         # We need to pass '--no-hardlinks' because right now there's nothing to
@@ -214,9 +572,13 @@ def _checkout(name, repo, ref, checkout):
             app.log(name, 'Upstream version %s' % get_version(checkout, ref))
 
 
-def source_date_epoch(checkout):
-    with app.chdir(checkout):
-        return check_output(['git', 'log', '-1', '--pretty=%ct'])[:-1]
+def source_date_epoch(dn):
+    gitdir = os.path.join(app.config['gits'], get_repo_name(dn['repo']))
+    epoch = objects(gitdir).commit_time(str(dn['ref']))
+    if epoch is None:
+        app.log(dn, 'Unable to find commit time for ref', dn['ref'],
+                exit=True)
+    return epoch
 
 
 def extract_commit(name, repo, ref, target_dir):
@@ -226,10 +588,11 @@ def extract_commit(name, repo, ref, target_dir):
     target_dir.
     '''
     gitdir = os.path.join(app.config['gits'], get_repo_name(repo))
-    if not os.path.exists(gitdir):
-        mirror(name, repo)
-    elif not mirror_has_ref(gitdir, ref):
-        update_mirror(name, repo, gitdir)
+    with mirror_lock(gitdir):
+        if not os.path.exists(gitdir):
+            mirror(name, repo)
+        elif not mirror_has_ref(gitdir, ref):
+            update_mirror(name, repo, gitdir)
 
     with tempfile.NamedTemporaryFile() as git_index_file:
         git_env = os.environ.copy()
@@ -268,14 +631,13 @@ def checkout_submodules(dn):
             app.log(dn, 'WARNING: fallback to submodule %s from' % path, url)
 
         try:
-            # list objects in the parent repo tree to find the commit
+            # look in the parent repo tree to find the commit
             # object that corresponds to the submodule
-            commit = check_output(['git', 'ls-tree', dn['ref'], path])
-
-            # read the commit hash from the output
-            fields = commit.split()
+            gitdir = os.path.join(app.config['gits'],
+                                  get_repo_name(dn['repo']))
+            fields = objects(gitdir).ls_tree(str(dn['ref']), path) or []
             if len(fields) >= 2 and fields[1] == 'commit':
-                submodule_commit = commit.split()[2]
+                submodule_commit = fields[2]
 
                 # fail if the commit hash is invalid
                 if len(submodule_commit) != 40:
@@ -17,37 +17,56 @@
 
 import sandboxlib
 import contextlib
+import fcntl
 import os
 import pipes
 import shutil
 import stat
 import tempfile
+from multiprocessing import cpu_count
 from subprocess import call, PIPE
 
 import app
 import cache
+import manifests
+import staging
 import utils
 from repos import get_repo_url
-from fs.copy import copy_fs
 
 
 # This must be set to a sandboxlib backend before the run_sandboxed() function
 # can be used.
 executor = None
 
+# sandboxlib closes inherited file descriptors, so builds open the jobserver
+# fifo themselves on this descriptor
+JOBSERVER_FD = 8
+
+# set to False once we find that overlay mounts don't work here
+_overlay = True
+
 
 @contextlib.contextmanager
 def setup(dn):
     tempfile.tempdir = app.config['tmp']
     dn['sandbox'] = tempfile.mkdtemp()
     os.environ['TMPDIR'] = app.config['tmp']
-    app.config['sandboxes'] += [dn['sandbox']]
     dn['checkout'] = os.path.join(dn['sandbox'], dn['name'] + '.build')
     dn['install'] = os.path.join(dn['sandbox'], dn['name'] + '.inst')
     dn['baserockdir'] = os.path.join(dn['install'], 'baserock')
     dn['tmp'] = os.path.join(dn['sandbox'], 'tmp')
     for directory in ['checkout', 'install', 'tmp', 'baserockdir']:
         os.makedirs(dn[directory])
+    if app.config.get('jobserver-fifo'):
+        # linked now, because once dependencies are staged on an overlay
+        # the sandbox's tmp is on a different filesystem from the fifo
+        os.link(app.config['jobserver-fifo'],
+                os.path.join(dn['tmp'], '.jobserver'))
+    dn.pop('layers', None)
+    dn.pop('ldconfig-done', None)
+    if dn.get('kind', 'chunk') == 'chunk':
+        # install() collects dependencies, for stage_dependencies() to stage
+        dn['layers'] = []
     dn['log'] = os.path.join(app.config['artifacts'],
                              dn['cache'] + '.build-log')
     if app.config.get('instances'):
@@ -58,8 +77,6 @@ def setup(dn):
 
     try:
         yield
-    except app.RetryException as e:
-        raise e
     except:
         import traceback
         app.log(dn, 'ERROR: surprise exception in sandbox', '')
@@ -72,24 +89,201 @@ def setup(dn):
     app.remove_dir(dn['sandbox'])
 
 
-def install(dn, component):
-    # populate dn['sandbox'] with the artifact files from component
+def installed(dn, component):
+    '''Return True if component is already installed in dn's sandbox.'''
+
     if os.path.exists(os.path.join(dn['sandbox'], 'baserock',
                                    component['name'] + '.meta')):
+        return True
+    unpacked = '%s.unpacked' % component.get('cache')
+    return any(os.path.basename(layer) == unpacked
+               for layer in dn.get('layers', []))
+
+
+def install(dn, component):
+    # populate dn['sandbox'] with the artifact files from component
+    if installed(dn, component):
         return
     app.log(dn, 'Sandbox: installing %s' % component['cache'], verbose=True)
-    if cache.get_cache(component) is False:
+    unpackdir = cache.get_unpacked(component)
+    if unpackdir is False:
         app.log(dn, 'Unable to get cache for', component['name'], exit=True)
-    unpackdir = cache.get_cache(component) + '.unpacked'
-    if dn.get('kind') is 'system':
-        copy_fs(unpackdir, dn['sandbox'])
+    if 'layers' in dn:
+        dn['layers'].append(unpackdir)
     else:
-        utils.hardlink_all_files(unpackdir, dn['sandbox'])
+        utils.hardlink_all_files(unpackdir, dn['sandbox'],
+                                 manifests.load(unpackdir))
+
+
+@contextlib.contextmanager
+def stage_dependencies(dn):
+    '''Stage the dependencies collected by install() while dn is built.
+
+    Dependencies are staged from the staging snapshot which covers most of
+    them, if there is one, with the rest on top.
+
+    With overlay staging, the snapshot and each remaining dependency's
+    unpacked artifact are read-only lower layers of an overlay mounted on
+    the sandbox, so staging costs one mount however many files there are.
+    The sandbox's own contents (the checkout, install dir and so on) are
+    moved to the writable upper layer, and moved back once the overlay is
+    unmounted. Otherwise, or if we can't mount an overlay, or if the overlay
+    would not match what hardlinks give us, the snapshot and the rest are
+    hardlinked into the sandbox.
+
+    '''
+    global _overlay
+
+    layers = dn.pop('layers', [])
+    staging.save(dn, layers)
+    snapshot, count, lock = staging.find(layers)
+    if snapshot and count == len(layers) and staging.ldconfig_done(snapshot):
+        dn['ldconfig-done'] = True
+    lower = ([snapshot] if snapshot else []) + layers[count:]
+
+    overlay = None
+    use_overlay = lower and _overlay and app.config.get('overlay-staging')
+    if use_overlay or app.config.get('check-overlaps', 'ignore') != 'ignore':
+        found = [manifests.load(layer) for layer in layers]
+    else:
+        found = [None] * count + [manifests.load(l) for l in layers[count:]]
+    if use_overlay:
+        differ = manifests.conflicts(found, count)
+        if differ:
+            app.log(dn, 'Staging with hardlinks, since an overlay would '
+                    'differ at', differ[0])
+        else:
+            overlay = _mount_overlay(dn, lower)
+            if overlay is None:
+                app.log(dn, 'WARNING: overlay staging failed, so using '
+                        'hardlinks from now on')
+                _overlay = False
+    if app.config.get('check-overlaps', 'ignore') != 'ignore':
+        # anything staged without walking it, we check using manifests
+        app.config['new-overlaps'] += manifests.overlaps(
+            found if overlay else found[:count])
+    if lower and not overlay:
+        if snapshot:
+            utils.hardlink_tree(snapshot, dn['sandbox'])
+            lock.close()
+        for layer, entries in zip(layers, found)[count:]:
+            utils.hardlink_all_files(layer, dn['sandbox'], entries)
+    try:
+        yield
+    finally:
+        if overlay:
+            _unmount_overlay(dn, overlay)
+        if lock:
+            lock.close()
+
+
+def _mount_overlay(dn, layers):
+    '''Mount layers on dn's sandbox, returning the overlay's working dir.'''
+
+    tempfile.tempdir = app.config['tmp']
+    overlay = tempfile.mkdtemp()
+    upper = os.path.join(overlay, 'upper')
+    os.mkdir(upper)
+    os.mkdir(os.path.join(overlay, 'work'))
+
+    # short relative names for the layers, so the mount options fit in a page
+    for number, layer in enumerate(layers):
+        os.symlink(layer, os.path.join(overlay, str(number)))
+    lower = ':'.join(str(n) for n in reversed(range(len(layers))))
+
+    for entry in os.listdir(dn['sandbox']):
+        os.rename(os.path.join(dn['sandbox'], entry),
+                  os.path.join(upper, entry))
+    options = 'lowerdir=%s,upperdir=upper,workdir=work' % lower
+    with open(os.devnull, 'w') as fnull:
+        if not call(['mount', '-t', 'overlay', 'overlay', '-o', options,
+                     dn['sandbox']], cwd=overlay, stdout=fnull, stderr=fnull):
+            app.log(dn, 'Staged %s dependencies as overlay layers' %
+                    len(layers), verbose=True)
+            return overlay
+
+    _restore(dn, overlay)
+    return None
+
+
+def _unmount_overlay(dn, overlay):
+    if call(['umount', dn['sandbox']]):
+        call(['umount', '-l', dn['sandbox']])
+    _restore(dn, overlay)
+
+
+def _restore(dn, overlay):
+    upper = os.path.join(overlay, 'upper')
+    for entry in os.listdir(upper):
+        os.rename(os.path.join(upper, entry),
+                  os.path.join(dn['sandbox'], entry))
+    app.remove_dir(overlay)
+
+
+def start_jobserver():
+    '''Create a GNU make jobserver shared by all builds in this ybd run.
+
+    The jobserver is a fifo holding one token per cpu, less the implicit slot
+    each running make already has. We keep it open for the whole run, so the
+    tokens are not lost while no builds are running.
+
+    '''
+    if not app.config.get('jobserver'):
+        return
+
+    tempfile.tempdir = app.config['tmp']
+    fifo = os.path.join(tempfile.mkdtemp(), 'jobserver')
+    os.mkfifo(fifo)
+    app.config['jobserver-fd'] = os.open(fifo, os.O_RDWR)
+    app.config['jobserver-fifo'] = fifo
+    tokens = max(cpu_count() - app.config.get('instances', 1), 0)
+    os.write(app.config['jobserver-fd'], '+' * tokens)
+    app.config['jobserver-tokens'] = tokens
+    app.log('SETUP', 'Jobserver tokens shared by all builds:', tokens)
+
+
+@contextlib.contextmanager
+def jobserver_tokens(count):
+    '''Hold count tokens from the jobserver, if there is one.
+
+    Builds with their own max-jobs run make -j max-jobs rather than use the
+    jobserver, so they take their tokens while they run, to keep within the
+    cpus shared by all builds. Tokens are taken by one build at a time, so
+    two partly served builds can't wait for each other forever.
+
+    '''
+    fd = app.config.get('jobserver-fd')
+    count = min(count, app.config.get('jobserver-tokens', 0))
+    if fd is None or count <= 0:
+        yield
+        return
+
+    tokens = ''
+    try:
+        with open(app.config['jobserver-fifo'] + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            while len(tokens) < count:
+                tokens += os.read(fd, count - len(tokens))
+        yield
+    finally:
+        if tokens:
+            os.write(fd, tokens)
+
+
+def jobserver_command(dn, command):
+    '''Return command, prefixed to open the jobserver fifo in the sandbox.'''
+
+    fifo = os.path.join(dn['tmp'], '.jobserver')
+    if dn.get('build-mode') != 'bootstrap':
+        fifo = '/tmp/.jobserver'
+    return 'exec %s<>%s\n%s' % (JOBSERVER_FD, fifo, command)
 
 
 def ldconfig(dn):
     conf = os.path.join(dn['sandbox'], 'etc', 'ld.so.conf')
-    if os.path.exists(conf):
+    if dn.pop('ldconfig-done', False):
+        app.log(dn, 'Staged ld.so.cache from snapshot', verbose=True)
+    elif os.path.exists(conf):
         path = os.environ['PATH']
         os.environ['PATH'] = '%s:/sbin:/usr/sbin:/usr/local/sbin' % path
         cmd_list = ['ldconfig', '-r', dn['sandbox']]
@@ -157,21 +351,29 @@ def run_sandboxed(dn, command, env=None, allow_parallel=False):
     # lazy load it in the chroot is made.
     unused = "Some Text".encode('string-escape')
 
-    argv = ['sh', '-c', '-e', command]
-
     cur_makeflags = env.get("MAKEFLAGS")
 
+    if allow_parallel and '--jobserver' in env.get('MAKEFLAGS', ''):
+        command = jobserver_command(dn, command)
+
+    argv = ['sh', '-c', '-e', command]
+
     # Adjust config for what the backend is capable of. The user will be warned
     # about any changes made.
     config = executor.degrade_config_for_capabilities(config, warn=False)
 
+    tokens = 0
+    if allow_parallel and '--jobserver' not in env.get('MAKEFLAGS', ''):
+        # the build's own slot is implicit, as it is for make
+        tokens = (dn.get('max-jobs') or 1) - 1
+
     try:
         if not allow_parallel:
             env.pop("MAKEFLAGS", None)
 
         app.log_env(dn['log'], env, argv_to_string(argv))
 
-        with open(dn['log'], "a") as logfile:
+        with open(dn['log'], "a") as logfile, jobserver_tokens(tokens):
             exit_code = 99
             try:
                 exit_code = executor.run_sandbox_with_redirection(
@@ -317,6 +519,10 @@ def env_vars_for_build(dn):
     env['PATH'] = ':'.join(path)
     env['PREFIX'] = dn.get('prefix') or '/usr'
     env['MAKEFLAGS'] = '-j%s' % (dn.get('max-jobs') or app.config['max-jobs'])
+    if app.config.get('jobserver-fifo') and not dn.get('max-jobs'):
+        # a component's own max-jobs is a limit, which the jobserver ignores
+        env['MAKEFLAGS'] = '-j --jobserver-fds=%s,%s --jobserver-auth=%s,%s' \
+            % ((JOBSERVER_FD,) * 4)
     env['TERM'] = 'dumb'
     env['SHELL'] = '/bin/sh'
     env['USER'] = env['USERNAME'] = env['LOGNAME'] = 'tomjon'
@@ -0,0 +1,354 @@
+# Copyright (C) 2016  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# =*= License: GPL-2 =*=
+
+'''Schedule the components of a target across a pool of workers.
+
+The dependency graph is calculated once, after cache-keys are known. A
+component becomes ready when everything it depends on is cached, and each
+ready component is handed to exactly one worker.
+
+Ready components are started in order of the longest remaining path to the
+target, using how long each component took in previous runs, so that the
+slowest chains of builds start first.
+
+Components which kbas already has are downloaded by background threads in
+this process, while the workers build. They don't need their dependencies,
+unless the download fails and we have to build them after all.
+
+'''
+
+import heapq
+import json
+import os
+import tempfile
+import time
+from multiprocessing import Process, Queue
+from multiprocessing.pool import ThreadPool
+from Queue import Empty
+
+import app
+from app import config, log
+from assembly import compose, fetch
+from cache import artifacts, cache_key, components, find_remote, get_cache
+
+
+def dependencies(dn):
+    '''Return the paths of components which must be cached before dn.'''
+
+    deps = []
+    for system in dn.get('systems', []):
+        deps += [s['path'] for s in system.get('subsystems', [])]
+        deps.append(system['path'])
+
+    if dn.get('kind', 'chunk') == 'chunk':
+        for it in dn.get('build-depends', []):
+            dependency = app.defs.get(it)
+            deps.append(dependency['path'])
+            deps += [app.defs.get(c)['path']
+                     for c in dependency.get('contents', [])]
+
+    for it in dn.get('contents', []):
+        item = app.defs.get(it)
+        if item.get('build-mode', 'staging') != 'bootstrap':
+            deps.append(item['path'])
+
+    return deps
+
+
+class Durations(object):
+    '''Seconds taken to assemble each component in previous runs.
+
+    Entries are kept per path, as a list of [cache-key, seconds] with the
+    most recent last, so we can look up an exact match for a cache-key or
+    fall back to the latest duration for the path.
+
+    '''
+
+    keep = 10
+
+    def __init__(self):
+        self._file = os.path.join(config['artifacts'], '.durations')
+        self._data = self._load()
+        self._new = {}
+
+    def _load(self):
+        try:
+            with open(self._file) as f:
+                return json.load(f)
+        except:
+            return {}
+
+    def get(self, dn):
+        history = self._data.get(dn['path'])
+        if not history:
+            return None
+        for key, seconds in history:
+            if key == dn.get('cache'):
+                return seconds
+        return history[-1][1]
+
+    def record(self, dn, seconds):
+        history = [h for h in self._data.get(dn['path'], [])
+                   if h[0] != dn['cache']]
+        history = (history + [[dn['cache'], seconds]])[-self.keep:]
+        self._data[dn['path']] = self._new[dn['path']] = history
+
+    def save(self):
+        '''Merge our new entries with the file, which may have changed.'''
+
+        if not self._new:
+            return
+        data = self._load()
+        data.update(self._new)
+        tempfile.tempdir = config['tmp']
+        fd, tmpfile = tempfile.mkstemp()
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.rename(tmpfile, self._file)
+        self._new = {}
+
+
+class Scheduler(object):
+
+    def __init__(self, target):
+        self.target = app.defs.get(target)
+        self.waiting = {}     # path -> set of paths not yet cached
+        self.dependents = {}  # path -> paths waiting for it
+        self.available = self._find_remote()  # paths which kbas has
+        self._add(self.target)
+        self.remote = self.available & set(self.waiting)  # to be fetched
+        self.durations = Durations()
+        self.priority = {}
+        self.ready = []
+        self.fetching = set()
+        for path in self.waiting:
+            self._prioritise(path)
+            if not self.waiting[path] and path not in self.remote:
+                self._push(path)
+        self.workers = []
+        self.results = Queue()
+        log('SCHEDULER', 'Components to be assembled:', len(self.waiting))
+        if self.remote:
+            log('SCHEDULER', 'Components to be downloaded:', len(self.remote))
+        if self.target['path'] in self.priority:
+            log('SCHEDULER', 'Estimated seconds on the critical path:',
+                max(self.priority.values()))
+
+    def _find_remote(self):
+        '''Return the paths of uncached components which kbas has.'''
+
+        if not config.get('kbas-url') or config.get('reproduce'):
+            return set()
+        wanted = {}
+        for dn in components(self.target):
+            if dn.get('kind', 'chunk') in config.get('kbas-upload', 'chunk'):
+                if cache_key(dn) is not False and not get_cache(dn):
+                    wanted[dn['cache']] = dn
+        if not wanted:
+            return set()
+        found = find_remote(sorted(wanted))
+        for key, dn in wanted.items():
+            if key not in found:
+                dn['tried'] = True  # so compose() doesn't ask kbas again
+        return set(wanted[key]['path'] for key in found)
+
+    def _add(self, dn):
+        if dn['path'] in self.waiting:
+            return True
+        if cache_key(dn) is False or get_cache(dn):
+            return False
+
+        self.waiting[dn['path']] = set()
+        if dn['path'] in self.available:
+            return True
+        for path in dependencies(dn):
+            if self._add(app.defs.get(path)):
+                self.waiting[dn['path']].add(path)
+                self.dependents.setdefault(path, []).append(dn['path'])
+        return True
+
+    def _estimate(self, dn):
+        seconds = self.durations.get(dn)
+        if seconds is None:
+            # no history, so assume chunks are slower than the rest
+            seconds = 60 if dn.get('kind', 'chunk') == 'chunk' else 1
+        return seconds
+
+    def _prioritise(self, path):
+        '''Return the estimated time from starting path to the target.'''
+
+        if path not in self.priority:
+            downstream = [self._prioritise(dependent)
+                          for dependent in self.dependents.get(path, [])]
+            self.priority[path] = (self._estimate(app.defs.get(path)) +
+                                   max(downstream or [0]))
+        return self.priority[path]
+
+    def queued(self):
+        '''Return the components to be built, most urgent first.'''
+
+        return [app.defs.get(path) for path in
+                sorted(self.waiting, key=lambda p: -self.priority[p])
+                if path not in self.remote]
+
+    def _push(self, path):
+        heapq.heappush(self.ready, (-self.priority[path], path))
+
+    def _pop(self):
+        return heapq.heappop(self.ready)[1]
+
+    def start(self):
+        '''Fork the worker processes, then start downloading from kbas.'''
+
+        if config.get('instances', 1) > 1:
+            self.tasks = Queue()
+            for fork in range(1, config['instances'] + 1):
+                worker = Process(target=self._work, args=(fork,))
+                worker.start()
+                self.workers.append(worker)
+
+        # threads only once we're done forking
+        self.downloads = ThreadPool(config.get('download-jobs', 4))
+        for path in sorted(self.remote, key=lambda p: -self.priority[p]):
+            self._fetch(path)
+
+    def _fetch(self, path):
+        self.fetching.add(path)
+        self.downloads.apply_async(self._download, (path,))
+
+    def _download(self, path):
+        try:
+            ok = fetch(app.defs.get(path))
+        except:
+            import traceback
+            traceback.print_exc()
+            ok = False
+        self.results.put((path, 0 if ok else None))
+
+    def _work(self, fork):
+        config['fork'] = fork
+        log('SCHEDULER', 'Started worker', fork)
+        parent = os.getppid()
+        while True:
+            try:
+                path = self.tasks.get(timeout=1)
+            except Empty:
+                if os.getppid() != parent:
+                    # the scheduler exited without stopping us
+                    break
+                continue
+            if path is None:
+                break
+            self.results.put((path, self._assemble(path)))
+
+    def _assemble(self, path):
+        '''Compose path, and return how many seconds it took.'''
+
+        starttime = time.time()
+        compose(path)
+        artifacts.flush()
+        return int(time.time() - starttime)
+
+    def _fetched(self, path, seconds):
+        '''Handle the result of a download, which may have failed.'''
+
+        self.fetching.discard(path)
+        if seconds is not None:
+            self._done(path)
+            return
+
+        # we'll have to build it after all, so it needs its dependencies
+        log(path, 'Unable to download, so building', cache_key(path))
+        self.remote.discard(path)
+        self.available.discard(path)
+        known = set(self.waiting)
+        del self.waiting[path]
+        self._add(app.defs.get(path))
+        self.waiting[path] = set(p for p in self.waiting[path]
+                                 if not get_cache(app.defs.get(p)))
+        for new in set(self.waiting) - known:
+            self._prioritise(new)
+            if new in self.available:
+                self.remote.add(new)
+                self._fetch(new)
+            elif not self.waiting[new]:
+                self._push(new)
+        if not self.waiting[path]:
+            self._push(path)
+
+    def _done(self, path, seconds=None):
+        if seconds is not None:
+            self.durations.record(app.defs.get(path), seconds)
+        if not get_cache(app.defs.get(path)):
+            log(path, 'ERROR: assembly did not produce', cache_key(path))
+            self.stop(abort=True)
+            log('SCHEDULER', 'Unable to complete', self.target['name'],
+                exit=True)
+        for dependent in self.dependents.get(path, []):
+            self.waiting[dependent].discard(path)
+            if not self.waiting[dependent]:
+                self._push(dependent)
+
+    def run(self):
+        '''Dispatch ready components until the target is cached.'''
+
+        busy = 0
+        while self.ready or busy or self.fetching:
+            if self.workers:
+                while self.ready and busy < len(self.workers):
+                    self.tasks.put(self._pop())
+                    busy += 1
+            elif self.ready:
+                path = self._pop()
+                self._done(path, self._assemble(path))
+                while not self.results.empty():
+                    self._fetched(*self.results.get())
+                continue
+
+            try:
+                path, seconds = self.results.get(timeout=1)
+            except Empty:
+                self._check_workers()
+                continue
+            if path in self.fetching:
+                self._fetched(path, seconds)
+            else:
+                busy -= 1
+                self._done(path, seconds)
+
+        self.stop()
+
+    def _check_workers(self):
+        for worker in self.workers:
+            if not worker.is_alive():
+                log('SCHEDULER', 'ERROR: worker exited with code',
+                    worker.exitcode)
+                self.stop(abort=True)
+                log('SCHEDULER', 'Unable to complete', self.target['name'],
+                    exit=True)
+
+    def stop(self, abort=False):
+        self.durations.save()
+        if hasattr(self, 'downloads'):
+            self.downloads.terminate()
+        for worker in self.workers:
+            if abort:
+                worker.terminate()
+            else:
+                self.tasks.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
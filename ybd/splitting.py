@@ -16,26 +16,41 @@
 
 import app
 from app import config, log, chdir
-from cache import get_cache
+from cache import get_unpacked
 import os
 import re
 import yaml
-from utils import copy_file_list
+from utils import copy_file_list, move_file_list
 
 
 def install_split_artifacts(dn):
-    '''Create the .meta files for a split system
+    '''Install the files a split system keeps into its sandbox
 
     Given a list of artifacts to split, writes new .meta files to
-    the baserock dir in dn['install'] and copies the files from the
-    sandbox to the dn['install']
+    the baserock dir in dn['install'] and copies just the files in those
+    artifacts from each chunk's unpacked artifact into dn['sandbox'], so
+    that the discarded splits are never staged at all. Returns the files
+    installed, for keep_split_artifacts().
 
     '''
 
+    filelist = set()
     for content in dn['contents']:
         key = content.keys()[0]
         stratum = app.defs.get(key)
-        move_required_files(dn, stratum, content[key])
+        filelist.update(move_required_files(dn, stratum, content[key]))
+    return filelist
+
+
+def keep_split_artifacts(dn, filelist):
+    '''Move the files installed by install_split_artifacts into dn['install']
+
+    This is done once the system-integration commands have run, so the
+    artifact has their changes to the files, as before.
+
+    '''
+
+    move_file_list(dn['sandbox'], dn['install'], filelist)
 
 
 def move_required_files(dn, stratum, artifacts):
@@ -67,6 +82,7 @@ def move_required_files(dn, stratum, artifacts):
     with open(split_stratum_metafile, "w") as f:
         yaml.safe_dump(split_stratum_metadata, f, default_flow_style=False)
 
+    installed = []
     for path in stratum['contents']:
         chunk = app.defs.get(path)
         if chunk.get('build-mode', 'staging') == 'bootstrap':
@@ -100,11 +116,24 @@ def move_required_files(dn, stratum, artifacts):
                     log(dn, 'Splits split_metadata is\n', split_metadata,
                         verbose=True)
                     log(dn, 'Splits filelist is\n', filelist, verbose=True)
-                    copy_file_list(dn['sandbox'], dn['install'], filelist)
+                    record_overlaps(dn, filelist)
+                    copy_file_list(get_unpacked(chunk), dn['sandbox'],
+                                   filelist)
+                    installed += filelist
         except:
             import traceback
             traceback.print_exc()
             log(dn, 'Failed to install split components', exit=True)
+    return installed
+
+
+def record_overlaps(dn, filelist):
+    '''Note files in filelist which are already installed in dn's sandbox'''
+
+    for path in filelist:
+        target = os.path.join(dn['sandbox'], path)
+        if os.path.lexists(target) and not os.path.isdir(target):
+            config['new-overlaps'] += ['/' + path]
 
 
 def check_overlaps(dn):
@@ -149,8 +178,7 @@ def get_metadata(dn):
 def path_to_metafile(dn):
     ''' Return the path to metadata file for dn. '''
 
-    return os.path.join(get_cache(dn) + '.unpacked', 'baserock',
-                        dn['name'] + '.meta')
+    return os.path.join(get_unpacked(dn), 'baserock', dn['name'] + '.meta')
 
 
 def compile_rules(dn):
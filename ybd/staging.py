@@ -0,0 +1,174 @@
+# Copyright (C) 2016  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# =*= License: GPL-2 =*=
+
+'''Keep snapshots of staged build dependencies, to stage them again cheaply.
+
+Many chunks are built with the same dependencies: most chunks in a stratum
+only depend on the stratum's build-depends, and a chunk which is being
+worked on is rebuilt with the same dependencies every time. So the staging
+root for a list of dependencies is kept in artifacts/.staging, hardlinked
+from their unpacked artifacts, with ldconfig already run in it.
+
+A sandbox is staged from the snapshot of the longest leading run of its
+dependencies, in the order they are installed, with the rest on top.
+Dependencies are matched in order rather than as a set, so that files
+which more than one of them provides are staged exactly as before.
+
+A snapshot is made the second time a list of dependencies is staged, and
+only the staging-snapshots most recently used are kept.
+
+'''
+
+import fcntl
+import hashlib
+import os
+import shutil
+import tempfile
+from subprocess import call
+
+import app
+import manifests
+import utils
+
+
+def _dir():
+    return os.path.join(app.config['artifacts'], '.staging')
+
+
+def _digests(layers):
+    '''Return the digest of each leading run of layers, shortest first.'''
+
+    digest = hashlib.sha256()
+    digests = []
+    for layer in layers:
+        digest.update(os.path.basename(layer) + '\n')
+        digests.append(digest.hexdigest())
+    return digests
+
+
+def find(layers):
+    '''Return the snapshot covering most of layers, and how many it covers.
+
+    Returns (root, count, lock). The snapshot can't be evicted until lock
+    is closed. If there is no snapshot, root and lock are None.
+
+    '''
+    if app.config.get('staging-snapshots'):
+        digests = _digests(layers)
+        for count in range(len(digests), 0, -1):
+            path = os.path.join(_dir(), digests[count - 1])
+            try:
+                lock = open(os.path.join(path, 'lock'))
+            except IOError:
+                continue
+            fcntl.flock(lock, fcntl.LOCK_SH)
+            if not os.path.isdir(os.path.join(path, 'root')):
+                # evicted while we were looking
+                lock.close()
+                continue
+            os.utime(path, None)
+            return os.path.join(path, 'root'), count, lock
+    return None, 0, None
+
+
+def ldconfig_done(root):
+    '''Return True if ldconfig has been run in the snapshot at root.'''
+
+    return os.path.exists(os.path.join(os.path.dirname(root), 'ldconfig'))
+
+
+def save(dn, layers):
+    '''Note that layers are being staged, and snapshot them the second time.'''
+
+    if not app.config.get('staging-snapshots') or not layers:
+        return
+    digest = _digests(layers)[-1]
+    path = os.path.join(_dir(), digest)
+    seen = path + '.seen'
+    if os.path.isdir(path):
+        return
+    if not os.path.exists(seen):
+        if not os.path.isdir(_dir()):
+            os.makedirs(_dir())
+        open(seen, 'w').close()
+        return
+
+    app.log(dn, 'Making staging snapshot of %s dependencies' % len(layers),
+            verbose=True)
+    tmpdir = tempfile.mkdtemp(dir=_dir(), prefix='.')
+    root = os.path.join(tmpdir, 'root')
+    os.mkdir(root)
+    open(os.path.join(tmpdir, 'lock'), 'w').close()
+    for layer in layers:
+        utils.hardlink_all_files(layer, root, manifests.load(layer))
+    if os.path.exists(os.path.join(root, 'etc', 'ld.so.conf')):
+        env = dict(os.environ)
+        env['PATH'] = '%s:/sbin:/usr/sbin:/usr/local/sbin' % env['PATH']
+        with open(os.devnull, 'w') as fnull:
+            if not call(['ldconfig', '-r', root], env=env, stdout=fnull,
+                        stderr=fnull):
+                open(os.path.join(tmpdir, 'ldconfig'), 'w').close()
+    try:
+        os.rename(tmpdir, path)
+    except OSError:
+        # another instance made the same snapshot
+        shutil.rmtree(tmpdir)
+    try:
+        os.remove(seen)
+    except OSError:
+        pass
+    evict(app.config.get('staging-snapshots'))
+
+
+def evict(keep=0):
+    '''Remove all but the keep most recently used snapshots.'''
+
+    if not os.path.isdir(_dir()):
+        return
+    snapshots = []
+    seen = []
+    for entry in os.listdir(_dir()):
+        path = os.path.join(_dir(), entry)
+        try:
+            if entry.endswith('.seen'):
+                seen.append((os.lstat(path).st_mtime, path))
+            elif not entry.startswith('.'):
+                snapshots.append((os.lstat(path).st_mtime, path))
+        except OSError:
+            # another worker or instance removed it
+            pass
+
+    for mtime, path in sorted(snapshots, reverse=True)[keep:]:
+        try:
+            with open(os.path.join(path, 'lock')) as lock:
+                # fails if a sandbox is using it
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                tmpdir = tempfile.mkdtemp(dir=_dir(), prefix='.')
+                try:
+                    os.rename(path, os.path.join(tmpdir, 'snapshot'))
+                finally:
+                    shutil.rmtree(tmpdir, ignore_errors=True)
+        except (IOError, OSError):
+            # in use, or another worker or instance evicted it first
+            continue
+
+    # lists of dependencies we've only seen once don't need remembering
+    # for long
+    for mtime, path in sorted(seen, reverse=True)[keep * 25:]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
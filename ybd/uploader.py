@@ -0,0 +1,197 @@
+# Copyright (C) 2016  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# =*= License: GPL-2 =*=
+
+'''Upload artifacts to kbas from a persistent queue.
+
+Artifacts to be uploaded are recorded as files in artifacts/.uploads, which
+are only removed once kbas has the artifact (or has refused it for good).
+A background process uploads them while ybd builds, retrying failures with
+exponential backoff. Anything left over is tried again by the next run, or
+by running ybd with mode: flush-uploads.
+
+'''
+
+import os
+import select
+import time
+from multiprocessing import Event, Process, Queue
+from multiprocessing.pool import ThreadPool
+from Queue import Empty
+
+import app
+import cache
+import utils
+
+
+_enabled = False
+_stopping = Event()
+_results = Queue()
+_uploader = None
+
+
+def _queued(key=''):
+    return os.path.join(app.config['artifacts'], '.uploads', key)
+
+
+def wanted(dn):
+    '''Return True if dn should be uploaded.'''
+
+    return _enabled and \
+        dn.get('kind', 'chunk') in app.config.get('kbas-upload', 'chunk')
+
+
+def queue(dn):
+    '''Record that dn should be uploaded, if we upload this kind.'''
+
+    if not wanted(dn):
+        return
+    if not os.path.isdir(_queued()):
+        os.makedirs(_queued())
+    with open(_queued(dn['cache']), 'w') as f:
+        f.write(dn.get('kind', 'chunk'))
+
+
+def start():
+    '''Fork the uploader, which runs until stop() is called.
+
+    We decide here whether uploads are wanted at all, because builds drop
+    kbas-url from their config if they find the server is not responding,
+    and we still want to queue their artifacts for later.
+
+    '''
+    global _enabled, _uploader
+    _enabled = app.config.get('kbas-url') is not None and \
+        app.config.get('kbas-password', 'insecure') != 'insecure'
+    if not _enabled:
+        return
+    _uploader = Process(target=_work)
+    _uploader.start()
+
+
+def _work():
+    app.config['reproduced'] = []
+
+    def retry(key, tries):
+        # once we are stopping, don't wait around for failed uploads
+        return not _stopping.is_set() or key not in tries
+
+    _upload_all(retry, _stopping.is_set)
+    _results.put(app.config['reproduced'])
+
+
+def stop(abort=False):
+    '''Upload anything not yet attempted, and stop the uploader.
+
+    Failed uploads are left in the queue for next time.
+
+    '''
+    global _uploader
+    if _uploader is None:
+        return
+    if abort:
+        _uploader.terminate()
+    else:
+        _stopping.set()
+        while True:
+            try:
+                app.config['reproduced'] += _results.get(timeout=1)
+                break
+            except Empty:
+                if not _uploader.is_alive():
+                    app.log('UPLOADS', 'WARNING: uploader exited early')
+                    break
+    _uploader.join()
+    _uploader = None
+
+
+def flush():
+    '''Upload everything in the queue, and return how many uploads failed.'''
+
+    attempts = app.config.get('upload-attempts', 6)
+    leftover = _upload_all(lambda key, tries: tries.get(key, 0) < attempts,
+                           lambda: True)
+    for key in leftover:
+        app.log(key, 'WARNING: still not uploaded after %s attempts' %
+                attempts)
+    return len(leftover)
+
+
+def _upload_all(retry, finished):
+    '''Upload queued artifacts, with up to upload-jobs running at a time.
+
+    retry(key, tries) says whether to try key (again), given the number of
+    failed attempts for each key so far. We return the keys left in the
+    queue once there is nothing left to try and finished() is True.
+
+    '''
+    if not os.path.isdir(_queued()):
+        os.makedirs(_queued())
+    pool = ThreadPool(app.config.get('upload-jobs', 2))
+    running = {}
+    tries = {}
+    due = {}
+    watch = utils.watch_directory(_queued())
+    try:
+        while True:
+            for key, result in running.items():
+                if result.ready():
+                    del running[key]
+                    if not result.get():
+                        tries[key] = tries.get(key, 0) + 1
+                        delay = min(2 ** tries[key], 300)
+                        due[key] = time.time() + delay
+                        if retry(key, tries):
+                            app.log(key, 'Retrying upload in %s seconds' %
+                                    delay)
+                        else:
+                            app.log(key, 'Leaving upload in the queue')
+
+            queued = sorted(os.listdir(_queued()))
+            todo = [k for k in queued if k not in running and retry(k, tries)]
+            if not running and not todo and finished():
+                return queued
+
+            for key in todo:
+                if due.get(key, 0) <= time.time():
+                    running[key] = pool.apply_async(_upload, (key,))
+
+            if watch is None:
+                time.sleep(1)
+            elif select.select([watch], [], [], 1)[0]:
+                os.read(watch, 65536)
+    finally:
+        if watch is not None:
+            os.close(watch)
+        pool.close()
+        pool.join()
+
+
+def _upload(key):
+    '''Try to upload key, and return False if it is worth trying again.'''
+
+    try:
+        with open(_queued(key)) as f:
+            kind = f.read()
+        dn = {'name': key.rsplit('.', 1)[0], 'cache': key, 'kind': kind}
+        with app.timer(dn, 'upload'):
+            if cache.upload(dn) is False:
+                return False
+        os.remove(_queued(key))
+    except:
+        import traceback
+        traceback.print_exc()
+        return False
+    return True
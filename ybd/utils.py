@@ -14,15 +14,21 @@
 #
 # =*= License: GPL-2 =*=
 
-import gzip
-import tarfile
 import contextlib
+import ctypes
+import ctypes.util
+import errno
+import fcntl
 import os
 import shutil
 import stat
+import threading
+import time
 from fs.osfs import OSFS
 from fs.multifs import MultiFS
 import calendar
+from multiprocessing.pool import ThreadPool
+from subprocess import call
 import app
 
 # The magic number for timestamps: 2011-11-11 11:11:11
@@ -108,13 +114,25 @@ def relative_symlink_target(root, symlink, target):
         return target
 
 
-def hardlink_all_files(srcpath, destpath):
+def hardlink_all_files(srcpath, destpath, manifest=None):
     '''Hardlink every file in the path to the staging-area
 
-    If an exception is raised, the staging-area is indeterminate.
+    If the manifest of the path is given (see manifests.py), it is used
+    instead of walking the path. If an exception is raised, the
+    staging-area is indeterminate.
 
     '''
-    _process_tree(destpath, srcpath, destpath, os.link)
+    if manifest is None:
+        _process_tree(destpath, srcpath, destpath, os.link)
+    else:
+        _process_manifest(destpath, srcpath, destpath, manifest, os.link)
+
+
+def hardlink_tree(srcpath, destpath):
+    '''Hardlink a tree of files which don't overlap with destpath, quickly.'''
+
+    if call(['cp', '-al', os.path.join(srcpath, '.'), destpath]):
+        app.log('UTILS', 'ERROR: unable to hardlink', srcpath, exit=True)
 
 
 def _process_tree(root, srcpath, destpath, actionfunc):
@@ -186,20 +204,212 @@ def _process_tree(root, srcpath, destpath, actionfunc):
         raise IOError('Cannot stage %s, unsupported type' % srcpath)
 
 
+def _process_manifest(root, srcpath, destpath, manifest, actionfunc):
+    '''Stage the entries of a manifest, as _process_tree() stages a tree.
+
+    Directories are all made first, so that everything else can be staged
+    on a pool of staging-jobs threads.
+
+    '''
+    if not os.path.lexists(destpath):
+        os.makedirs(destpath)
+
+    others = []
+    for entry in manifest:
+        target = os.path.join(destpath, entry[0])
+        if entry[1] != 'd':
+            others.append(entry)
+        elif os.path.lexists(target):
+            app.log('OVERLAPS', 'WARNING: overlap at', target, verbose=True)
+            if not os.path.isdir(os.path.realpath(target)):
+                raise IOError('Destination not a directory: source has %s'
+                              ' destination has %s' %
+                              (os.path.join(srcpath, entry[0]), target))
+        else:
+            os.makedirs(target)
+
+    def stage(entry):
+        path, kind, mode, size, target = entry[:5]
+        dest = os.path.join(destpath, path)
+        if os.path.lexists(dest):
+            app.log('OVERLAPS', 'WARNING: overlap at', dest, verbose=True)
+            if kind == 'l':
+                app.config['new-overlaps'] += ['/' + path]
+                if os.path.isdir(dest) and not os.path.islink(dest):
+                    shutil.rmtree(dest)
+                else:
+                    os.remove(dest)
+            else:
+                os.remove(dest)
+        if kind == 'l':
+            os.symlink(relative_symlink_target(root, dest, target), dest)
+        elif kind == 'f':
+            actionfunc(os.path.join(srcpath, path), dest)
+        else:
+            os.mknod(dest, mode | (stat.S_IFCHR if kind == 'c' else
+                                   stat.S_IFBLK), target)
+            os.chmod(dest, mode)
+
+    jobs = app.config.get('staging-jobs', 1)
+    if jobs > 1 and len(others) > jobs:
+        pool = ThreadPool(jobs)
+        try:
+            pool.map(stage, others)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for entry in others:
+            stage(entry)
+
+
+FICLONE = 0x40049409
+
+# the best way of copying we have found to work, per pair of filesystems
+_copy_methods = {}
+
+
+def _libc():
+    return ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+
+def _reflink(infd, outfd, size):
+    fcntl.ioctl(outfd, FICLONE, infd)
+
+
+def _copy_file_range(infd, outfd, size):
+    copy_file_range = _libc().copy_file_range
+    copy_file_range.restype = ctypes.c_ssize_t
+    copy_file_range.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int,
+                                ctypes.c_void_p, ctypes.c_size_t,
+                                ctypes.c_uint]
+    _copy_in_kernel(lambda n: copy_file_range(infd, None, outfd, None, n, 0),
+                    size)
+
+
+def _sendfile(infd, outfd, size):
+    sendfile = _libc().sendfile
+    sendfile.restype = ctypes.c_ssize_t
+    sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p,
+                         ctypes.c_size_t]
+    _copy_in_kernel(lambda n: sendfile(outfd, infd, None, n), size)
+
+
+def _copy_in_kernel(copy, size):
+    copied = 0
+    while copied < size:
+        count = copy(min(size - copied, 1 << 30))
+        if count < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        if count == 0:
+            break
+        copied += count
+
+
+def _copy_userspace(infd, outfd, size):
+    while True:
+        data = os.read(infd, 4 * 1024 * 1024)
+        if not data:
+            break
+        os.write(outfd, data)
+
+
+_COPY_METHODS = [_reflink, _copy_file_range, _sendfile, _copy_userspace]
+
+
+def copy_file(srcpath, destpath):
+    '''Copy a file's contents and permissions, sharing its data if we can.
+
+    Reflinks cost nothing on filesystems which have them (btrfs, XFS). If
+    not, copying within the kernel avoids reading everything into python.
+    Whatever works is remembered for the pair of filesystems involved.
+
+    '''
+    _copy_data(srcpath, destpath)
+    shutil.copystat(srcpath, destpath)
+
+
+def _copy_data(srcpath, destpath):
+    infd = os.open(srcpath, os.O_RDONLY)
+    try:
+        st = os.fstat(infd)
+        outfd = os.open(destpath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                        0o600)
+        try:
+            devices = (st.st_dev, os.fstat(outfd).st_dev)
+            start = _copy_methods.get(devices, 0)
+            for number, method in enumerate(_COPY_METHODS[start:], start):
+                try:
+                    method(infd, outfd, st.st_size)
+                    _copy_methods[devices] = number
+                    break
+                except (OSError, IOError, AttributeError) as e:
+                    if method is _copy_userspace or \
+                            getattr(e, 'errno', None) in (errno.EIO,
+                                                          errno.ENOSPC):
+                        raise
+                    # not supported here, so start again with the next way
+                    os.lseek(infd, 0, os.SEEK_SET)
+                    os.lseek(outfd, 0, os.SEEK_SET)
+                    os.ftruncate(outfd, 0)
+        finally:
+            os.close(outfd)
+    finally:
+        os.close(infd)
+
+
+def copy_tree(srcpath, destpath):
+    '''Copy a tree into destpath as tar would, copying files as copy_file().
+
+    Ownership, permissions, mtimes and the hardlinks within the tree are
+    kept.
+
+    '''
+    links = {}
+    dirs = []
+    for dirname, subdirs, filenames in os.walk(srcpath):
+        target = os.path.normpath(os.path.join(destpath,
+                                               os.path.relpath(dirname,
+                                                               srcpath)))
+        if not os.path.isdir(target):
+            os.mkdir(target)
+        dirs.append((dirname, target))
+        for name in subdirs + filenames:
+            src = os.path.join(dirname, name)
+            dest = os.path.join(target, name)
+            st = os.lstat(src)
+            if stat.S_ISDIR(st.st_mode):
+                continue
+            elif stat.S_ISLNK(st.st_mode):
+                os.symlink(os.readlink(src), dest)
+            elif st.st_nlink > 1 and st.st_ino in links:
+                os.link(links[st.st_ino], dest)
+                continue
+            elif stat.S_ISREG(st.st_mode):
+                _copy_data(src, dest)
+                links[st.st_ino] = dest
+            else:
+                os.mknod(dest, st.st_mode, st.st_rdev)
+            os.lchown(dest, st.st_uid, st.st_gid)
+            if not stat.S_ISLNK(st.st_mode):
+                # after chown, which clears setuid and setgid bits
+                shutil.copystat(src, dest)
+
+    # directories last, since filling them changes their mtimes
+    for dirname, target in reversed(dirs):
+        st = os.lstat(dirname)
+        os.lchown(target, st.st_uid, st.st_gid)
+        shutil.copystat(dirname, target)
+
+
 def copy_file_list(srcpath, destpath, filelist):
     '''Copy every file in the source path to the destination.
 
     If an exception is raised, the staging-area is indeterminate.
 
     '''
-
-    def _copyfun(inpath, outpath):
-        with open(inpath, "r") as infh:
-            with open(outpath, "w") as outfh:
-                shutil.copyfileobj(infh, outfh, 1024*1024*4)
-        shutil.copystat(inpath, outpath)
-
-    _process_list(srcpath, destpath, filelist, _copyfun)
+    _process_list(srcpath, destpath, filelist, copy_file)
 
 
 def hardlink_file_list(srcpath, destpath, filelist):
@@ -211,6 +421,16 @@ def hardlink_file_list(srcpath, destpath, filelist):
     _process_list(srcpath, destpath, filelist, os.link)
 
 
+def move_file_list(srcpath, destpath, filelist):
+    '''Move every file in the list from the source path to the destination
+
+    Directories are created in the destination rather than moved, so files
+    which aren't in the list are left behind.
+
+    '''
+    _process_list(srcpath, destpath, filelist, os.rename)
+
+
 def _copy_directories(srcdir, destdir, target):
     ''' Recursively make directories in target area and copy permissions
     '''
@@ -290,25 +510,10 @@ def _process_list(srcdir, destdir, filelist, actionfunc):
                           ' type.' % srcpath)
 
 
-def make_deterministic_gztar_archive(base_name, root_dir, time=1321009871.0):
-    '''Make a gzipped tar archive of contents of 'root_dir'.
-
-    This function takes extra steps to ensure the output is deterministic,
-    compared to shutil.make_archive(). First, it sorts the results of
-    os.listdir() to ensure the ordering of the files in the archive is the
-    same. Second, it sets a fixed timestamp and filename in the gzip header.
+def add_directory_to_tarfile(f_tar, root_dir):
+    '''Add the contents of root_dir to f_tar, sorted, directories first.'''
 
-    As well as fixing https://bugs.python.org/issue24465, to make this function
-    redundant we would need to patch shutil.make_archive() so we could manually
-    set the timestamp and filename set in the gzip file header.
-
-    '''
-    # It's hard to implement this function by monkeypatching
-    # shutil.make_archive() because of the way the tarfile module includes the
-    # filename of the tarfile in the gzip header. So we have to reimplement
-    # shutil.make_archive().
-
-    def add_directory_to_tarfile(f_tar, dir_name, dir_arcname):
+    def add(dir_name, dir_arcname):
         for filename in sorted(os.listdir(dir_name)):
             name = os.path.join(dir_name, filename)
             arcname = os.path.join(dir_arcname, filename)
@@ -316,38 +521,21 @@ def make_deterministic_gztar_archive(base_name, root_dir, time=1321009871.0):
             f_tar.add(name=name, arcname=arcname, recursive=False)
 
             if os.path.isdir(name) and not os.path.islink(name):
-                add_directory_to_tarfile(f_tar, name, arcname)
-
-    with open(base_name + '.tar.gz', 'wb') as f:
-        gzip_context = gzip.GzipFile(
-            filename='', mode='wb', fileobj=f, mtime=time)
-        with gzip_context as f_gzip:
-            with tarfile.TarFile(mode='w', fileobj=f_gzip) as f_tar:
-                add_directory_to_tarfile(f_tar, root_dir, '.')
+                add(name, arcname)
 
+    add(root_dir, '.')
 
-def make_deterministic_tar_archive(base_name, root):
-    '''Make a tar archive of contents of 'root_dir'.
 
-    This function takes extra steps to make the output more deterministic,
-    compared to shutil.make_archive() - it sorts the results to ensure
-    the ordering of the files in the archive is always the same.
+def add_system_to_tarfile(f_tar, root):
+    '''Add the contents of root to f_tar, sorted, directories last.'''
 
-    Also this puts the directory last, to workaround a bug in docker/overlayfs
-    runners - see https://gitlab.com/baserock/ybd/issues/241
-
-    FIXME: make this do timestamps
-
-    '''
-
-    with app.chdir(root), open(base_name + '.tar', 'wb') as f:
-        with tarfile.TarFile(mode='w', fileobj=f) as f_tar:
-            directories = [d[0] for d in os.walk('.')]
-            for d in sorted(directories):
-                files = [os.path.join(d, f) for f in os.listdir(d)]
-                for path in sorted(files):
-                    f_tar.add(name=path, recursive=False)
-                f_tar.add(name=d, recursive=False)
+    with app.chdir(root):
+        directories = [d[0] for d in os.walk('.')]
+        for d in sorted(directories):
+            files = [os.path.join(d, f) for f in os.listdir(d)]
+            for path in sorted(files):
+                f_tar.add(name=path, recursive=False)
+            f_tar.add(name=d, recursive=False)
 
 
 def _find_extensions(paths):
@@ -373,10 +561,64 @@ def find_extensions():
     return _find_extensions(paths)
 
 
-def sorted_ls(path):
-    def mtime(f):
-        return os.stat(os.path.join(path, f)).st_mtime
-    return list(sorted(os.listdir(path), key=mtime))
+def watch_directory(path):
+    '''Return an inotify fd which is readable when entries appear in path.
+
+    Returns None if inotify is not available on this platform.
+
+    '''
+    IN_CREATE, IN_MOVED_TO, IN_CLOEXEC = 0x100, 0x80, 0o2000000
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | IN_CLOEXEC)
+    except (AttributeError, OSError):
+        return None
+    if fd < 0:
+        return None
+    if libc.inotify_add_watch(fd, path, IN_CREATE | IN_MOVED_TO) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+class TokenBucket(object):
+    '''Limit the rate of something (eg bytes downloaded) across threads.
+
+    Callers consume() what they have used, and are made to sleep for as long
+    as it takes to pay back any debt at the given rate. A rate of zero means
+    no limit.
+
+    '''
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def consume(self, amount):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.rate,
+                              self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= amount
+            delay = -self.tokens / float(self.rate)
+        if delay > 0:
+            time.sleep(delay)
+
+
+def tree_size(path):
+    '''Return the total size of the files under path.'''
+
+    if not os.path.isdir(path):
+        return os.lstat(path).st_size if os.path.lexists(path) else 0
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            total += os.lstat(os.path.join(dirpath, filename)).st_size
+    return total
 
 
 @contextlib.contextmanager